@@ -0,0 +1,340 @@
+'''
+This file implements the distributed execution of Cut&Shoot with worker agents.
+An agent runs on a host and executes, on the backends it advertises, the jobs (a fragment variation with its shots) sent by a coordinator, returning
+the counts. The coordinator is RemoteDispatcher, which has the same run interface of qukit.Dispatcher: it ships the jobs of a dispatch to the agents
+supporting their backends and, if an agent disconnects, reassigns its jobs to the other agents.
+
+usage (from the src folder): python agents.py --port PORT --backends '[["ibm_aer", "aer.fake_kyoto"]]' [--host HOST] [--shot-chunk-size SIZE]
+    [--emulated-backends PROFILES]
+Several agents can run on the same host (e.g. localhost) on different ports.
+
+Protocol: JSON messages over a multiprocessing.connection authenticated with the key in the CUTNSHOT_AGENT_AUTHKEY environment variable,
+required unless the agents are on localhost.
+    coordinator -> agent: ["hello"]                                                   agent -> coordinator: ["backends", [[provider, backend], ...]]
+    coordinator -> agent: ["job", job_id, provider, backend, circuit, shots, options]  agent -> coordinator: ["heartbeat", job_id] while the job runs,
+                                                                                                           then ["result", job_id, counts] or ["error", job_id, message]
+    coordinator -> agent: ["bye"]
+where circuit is a qukit.VirtualCircuit as a dictionary and options are the JOB_OPTIONS of the qukit.Dispatcher of the coordinator (the ones given
+to the agent on the command line are its defaults).
+A job the agent reports as an error, or running longer than the job timeout (none by default), is retried with an exponential backoff up to
+MAX_JOB_ATTEMPTS times, then the run fails. An agent sends a heartbeat every HEARTBEAT_INTERVAL seconds while it executes a job: an agent silent
+for the timeout (AGENT_TIMEOUT by default), whatever the duration of its job, is treated as disconnected.
+'''
+import threading, json, logging, os, collections, datetime, time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from argparse import ArgumentParser
+from os.path import join, dirname
+from qukit import Dispatcher, Job, Result, VirtualCircuit, run_circuits_on_backend
+
+logger = logging.getLogger("cutnshot")
+
+#key of the agents bound to localhost when CUTNSHOT_AGENT_AUTHKEY is not set, it is public: never used for other hosts
+LOCAL_AUTHKEY = "cutnshot"
+LOCAL_HOSTS = {"127.0.0.1", "localhost", "::1"}
+#seconds an agent can be silent before it is treated as disconnected, and seconds between the heartbeats of an agent executing a job
+AGENT_TIMEOUT = 60
+HEARTBEAT_INTERVAL = 10
+MAX_JOB_ATTEMPTS = 3
+JOB_RETRY_BACKOFF = 1.0
+#options of the qukit.Dispatcher sent with the jobs
+JOB_OPTIONS = ["shot_chunk_size", "auto_simulation_method", "emulated_backends"]
+
+def get_authkey(hosts):
+    #hosts: the hosts the agents are bound to
+    if "CUTNSHOT_AGENT_AUTHKEY" in os.environ:
+        return os.environ["CUTNSHOT_AGENT_AUTHKEY"].encode()
+    if all(host in LOCAL_HOSTS for host in hosts):
+        return LOCAL_AUTHKEY.encode()
+    raise ValueError("CUTNSHOT_AGENT_AUTHKEY must be set to use agents beyond localhost")
+
+def send(conn, message):
+    conn.send_bytes(json.dumps(message).encode())
+
+def receive(conn, timeout=None):
+    #a silent peer raises TimeoutError, an OSError as a disconnection
+    if timeout is not None and not conn.poll(timeout):
+        raise TimeoutError(f"No message within {timeout} seconds")
+    return json.loads(conn.recv_bytes())
+
+
+class JobTimeoutError(Exception):
+    pass
+
+
+class Agent:
+
+    def __init__(self, backends, shot_chunk_size=None, emulated_backends=None, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.backends = [list(b) for b in backends]
+        #options of the jobs that do not give them
+        self.default_options = {"shot_chunk_size": shot_chunk_size, "emulated_backends": emulated_backends}
+        self.heartbeat_interval = heartbeat_interval
+        #dispatcher of each set of job options, with its backends
+        self._dispatchers = {}
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def get_dispatcher(self, options):
+        options = {**self.default_options, **{k: v for k, v in options.items() if k in JOB_OPTIONS and v is not None}}
+        key = json.dumps(options, sort_keys=True)
+        with self._lock:
+            if key not in self._dispatchers:
+                self._dispatchers[key] = Dispatcher(**options)
+            return key, self._dispatchers[key]
+
+    def get_backend(self, key, dispatcher, provider, backend):
+        with self._lock:
+            if (key, provider, backend) not in self._backends:
+                self._backends[(key, provider, backend)] = dispatcher._get_backend(provider, backend)
+            return self._backends[(key, provider, backend)]
+
+    def execute(self, provider, backend, circuit, shots, options=None):
+        key, dispatcher = self.get_dispatcher(options or {})
+        jobs = run_circuits_on_backend(self.get_backend(key, dispatcher, provider, backend), [(circuit, shots)], dispatcher.shot_chunk_size, dispatcher._get_options_fun(provider, backend))
+        if jobs[0] is None:
+            raise RuntimeError(f"Job failed on {provider}/{backend}")
+        return jobs[0].results[0].counts
+
+    def handle(self, conn):
+        #the heartbeats are sent by another thread while the job runs
+        send_lock = threading.Lock()
+        def reply(message):
+            with send_lock:
+                send(conn, message)
+        def heartbeat(job_id, done):
+            while not done.wait(self.heartbeat_interval):
+                try:
+                    reply(["heartbeat", job_id])
+                except (EOFError, OSError):
+                    return
+        try:
+            while True:
+                message = receive(conn)
+                if message[0] == "hello":
+                    reply(["backends", self.backends])
+                elif message[0] == "job":
+                    _, job_id, provider, backend, circuit, shots = message[:6]
+                    options = message[6] if len(message) > 6 else {}
+                    if [provider, backend] not in self.backends:
+                        reply(["error", job_id, f"Backend {backend} of provider {provider} not available on this agent"])
+                        continue
+                    done = threading.Event()
+                    beats = threading.Thread(target=heartbeat, args=(job_id, done), daemon=True)
+                    beats.start()
+                    try:
+                        counts = self.execute(provider, backend, VirtualCircuit.from_dict(circuit), shots, options)
+                    except Exception as e:  # pylint: disable=broad-except
+                        logger.exception(f"Job {job_id} failed")
+                        done.set()
+                        beats.join()
+                        reply(["error", job_id, repr(e)])
+                        continue
+                    done.set()
+                    beats.join()
+                    reply(["result", job_id, counts])
+                elif message[0] == "bye":
+                    break
+        except (EOFError, OSError):
+            logger.info("Coordinator disconnected")
+        finally:
+            conn.close()
+
+    def serve(self, host, port, authkey=None):
+        if authkey is None:
+            authkey = get_authkey([host])
+        with Listener((host, port), authkey=authkey) as listener:
+            logger.info(f"Agent listening on {host}:{port} with backends {self.backends} "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:  # pylint: disable=broad-except
+                    #e.g. a client with the wrong key
+                    logger.warning(f"Connection refused: {e!r}")
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+class RemoteDispatcher:
+
+    def __init__(self, agents, authkey=None, timeout=AGENT_TIMEOUT, max_job_attempts=MAX_JOB_ATTEMPTS, job_timeout=None, options=None):
+        #agents: list of [host, port]
+        self.agents = [tuple(a) for a in agents]
+        self.authkey = authkey if authkey is not None else get_authkey([host for host, _ in self.agents])
+        #timeout: seconds an agent can be silent (no reply nor heartbeat) before it is treated as disconnected, None to wait forever
+        self.timeout = timeout
+        self.max_job_attempts = max_job_attempts
+        #job_timeout: seconds a job can run on an agent before it is retried, None for no limit
+        self.job_timeout = job_timeout
+        #options: options of the qukit.Dispatcher executing the jobs on the agents (see JOB_OPTIONS)
+        self.options = {k: v for k, v in (options or {}).items() if k in JOB_OPTIONS}
+
+    def _open(self, host, port):
+        #connection to the agent and its backends, None if the agent is not available
+        conn = None
+        try:
+            conn = Client((host, port), authkey=self.authkey)
+            send(conn, ["hello"])
+            kind, backends = receive(conn, self.timeout)
+            if kind != "backends":
+                raise ValueError(f"Unexpected reply {kind} to hello")
+            return conn, {tuple(b) for b in backends}
+        except (OSError, EOFError, AuthenticationError, ValueError, KeyError, TypeError) as e:
+            #e.g. an agent with another key or a malformed hello: the run goes on with the other agents
+            logger.warning(f"Agent {host}:{port} not available: {e!r}")
+            if conn is not None:
+                conn.close()
+            return None
+
+    def _connect(self):
+        connections = []
+        for host, port in self.agents:
+            opened = self._open(host, port)
+            if opened is not None:
+                connections.append(((host, port), opened[0], opened[1]))
+        return connections
+
+    def _receive_reply(self, conn):
+        #reply to a job, skipping the heartbeats: a silent agent raises TimeoutError, a job past the job timeout JobTimeoutError
+        deadline = time.monotonic() + self.job_timeout if self.job_timeout is not None else None
+        while True:
+            wait = self.timeout
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise JobTimeoutError(f"Job running for more than {self.job_timeout} seconds")
+                wait = left if wait is None else min(wait, left)
+            try:
+                message = receive(conn, wait)
+            except TimeoutError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise JobTimeoutError(f"Job running for more than {self.job_timeout} seconds") from None
+                raise
+            if message[0] != "heartbeat":
+                return message
+
+    def run(self, dispatch):
+        connections = self._connect()
+        jobs = {}
+        results = {}
+        for provider in dispatch:
+            results[provider] = {}
+            for backend in dispatch[provider]:
+                if not any((provider, backend) in backends for _, _, backends in connections):
+                    for _, conn, _ in connections:
+                        conn.close()
+                    raise ValueError(f"Backend {backend} not supported for provider {provider} by any agent")
+                results[provider][backend] = [None]*len(dispatch[provider][backend])
+                for i, (circuit, shots) in enumerate(dispatch[provider][backend]):
+                    jobs[len(jobs)] = (provider, backend, i, circuit, shots)
+
+        state = {"pending": collections.deque(jobs), "in_flight": 0, "attempts": collections.Counter(), "error": None}
+        condition = threading.Condition()
+
+        def next_job(backends):
+            #called holding the condition: waits until there is a job for the agent or no job can come anymore
+            while True:
+                if state["error"] is not None:
+                    return None
+                for job_id in state["pending"]:
+                    if jobs[job_id][:2] in backends:
+                        state["pending"].remove(job_id)
+                        state["in_flight"] += 1
+                        return job_id
+                if state["in_flight"] == 0:
+                    return None
+                #a job in flight on another agent may be reassigned
+                condition.wait()
+
+        def work(address, conn, backends):
+            while True:
+                with condition:
+                    job_id = next_job(backends)
+                if job_id is None:
+                    break
+                provider, backend, i, circuit, shots = jobs[job_id]
+                stale = False
+                try:
+                    send(conn, ["job", job_id, provider, backend, circuit.to_dict(), shots, self.options])
+                    reply = self._receive_reply(conn)
+                except JobTimeoutError as e:
+                    #a failed attempt of the job, the agent is still busy with it and is not used anymore
+                    reply = ["error", job_id, repr(e)]
+                    stale = True
+                except (EOFError, OSError) as e:
+                    logger.warning(f"Agent {address[0]}:{address[1]} disconnected, reassigning its jobs: {e!r}")
+                    with condition:
+                        state["pending"].appendleft(job_id)
+                        state["in_flight"] -= 1
+                        condition.notify_all()
+                    return
+                backoff = None
+                with condition:
+                    if reply[0] == "result":
+                        results[provider][backend][i] = Job(f"{provider}/{backend}", [Result(circuit, reply[2])])
+                    else:
+                        state["attempts"][job_id] += 1
+                        logger.warning(f"Job on {provider}/{backend} failed on agent {address[0]}:{address[1]} (attempt {state['attempts'][job_id]}): {reply[2]}")
+                        if state["attempts"][job_id] >= self.max_job_attempts:
+                            state["error"] = RuntimeError(f"Job on {provider}/{backend} failed {state['attempts'][job_id]} times: {reply[2]}")
+                        else:
+                            backoff = JOB_RETRY_BACKOFF * 2**(state["attempts"][job_id]-1)
+                    if backoff is None:
+                        state["in_flight"] -= 1
+                        condition.notify_all()
+                if backoff is not None:
+                    #the job stays in flight during the backoff, then only the failed job is queued again
+                    time.sleep(backoff)
+                    with condition:
+                        state["pending"].append(job_id)
+                        state["in_flight"] -= 1
+                        condition.notify_all()
+                if stale:
+                    #the agent is still executing the timed out job: the next jobs go to a new connection
+                    conn.close()
+                    opened = self._open(*address)
+                    if opened is None:
+                        return
+                    conn = opened[0]
+                    with condition:
+                        opened_connections.append(conn)
+            try:
+                send(conn, ["bye"])
+            except (EOFError, OSError):
+                pass
+
+        #connections opened again after a job timeout
+        opened_connections = []
+        threads = [threading.Thread(target=work, args=c) for c in connections]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for conn in [conn for _, conn, _ in connections] + opened_connections:
+            conn.close()
+
+        if state["error"] is not None:
+            raise state["error"]
+        if state["pending"]:
+            missing = {jobs[job_id][:2] for job_id in state["pending"]}
+            raise RuntimeError(f"No agent left to execute the jobs on {missing}")
+        return results
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv(join(dirname(__file__), '.env'))
+    logging.basicConfig(level=logging.ERROR)
+    logger.setLevel(logging.INFO)
+    parser = ArgumentParser(prog='agents.py', description='Worker agent executing Cut&Shoot jobs on local backends.')
+    parser.add_argument('--host', type=str, help='Host address of the agent.', default="127.0.0.1")
+    parser.add_argument('--port', type=int, help='Port of the agent.', required=True)
+    parser.add_argument('--backends', type=str, help='JSON list of [provider, backend] executed by the agent.', required=True)
+    parser.add_argument('--shot-chunk-size', type=int, help='Maximum number of shots of a single execution.', default=None)
+    parser.add_argument('--emulated-backends', type=str, help='JSON object with the profiles of the emulated backends (see emulator.py).', default=None)
+    args = parser.parse_args()
+
+    agent = Agent(json.loads(args.backends), args.shot_chunk_size, json.loads(args.emulated_backends) if args.emulated_backends else None)
+    agent.serve(args.host, args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+'''
+Deterministic checks of the numerics and of the scheduling of the pipeline, on stubbed backends (no provider is contacted):
+    sew: the exact sew of qiskit_tool matches the statevector of random circuits, for every width of the fragments and for Pauli-sum observables
+    sampled: the sampled sew of qiskit_tool is unbiased, the mean of the estimates over many seeds is within a few standard errors of the exact
+        value, and the standard error it reports matches the spread of the estimates
+    binpacking: the bin-packing shot-wise policy assigns exactly the shots of every fragment, each fragment at most once per backend
+    speculative: the speculative dispatcher cancels the stalled copy of a job, credits its result to the backend that finished it first and
+        returns every job once, without waiting for the stalled copy
+The fragments of qiskit_tool are simulated with numpy instead of exporting their QASM, so the cutting checks do not need qiskit; the speculative
+check parses the QASM of its circuits with qiskit. Each check reports a JSON line, the script exits with status 1 if any check fails.
+
+usage (from the src folder): python benchmarks/checks.py [--checks sew sampled binpacking speculative] [--seed SEED] [--runs RUNS]
+'''
+import json, os, sys, random, threading
+from argparse import ArgumentParser
+from itertools import product
+from time import perf_counter
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAULIS = {"I": np.eye(2), "X": np.array([[0, 1], [1, 0]]), "Y": np.array([[0, -1j], [1j, 0]]), "Z": np.diag([1, -1])}
+PREPARATION_MATRICES = {"x": PAULIS["X"], "h": np.array([[1, 1], [1, -1]])/np.sqrt(2), "s": np.diag([1, 1j])}
+CX = np.eye(4)[[0, 1, 3, 2]]
+
+SPECULATIVE_STALL = 5.0
+SPECULATIVE_QASM = 'OPENQASM 2.0;\ninclude "qelib1.inc";\nqreg q[2];\ncreg c[2];\nh q[0];\ncx q[0],q[1];\nmeasure q -> c;\n'
+
+
+def ry(theta):
+    return np.array([[np.cos(theta/2), -np.sin(theta/2)], [np.sin(theta/2), np.cos(theta/2)]])
+
+def rz(theta):
+    return np.diag([np.exp(-1j*theta/2), np.exp(1j*theta/2)])
+
+def random_ops(rng, qubits, gates):
+    #operations as qiskit_tool.circuit_ops gives them, with the matrix of the gate in place of the qiskit operation
+    ops = []
+    for _ in range(gates):
+        if rng.random() < 0.5:
+            ops.append(((ry if rng.random() < 0.5 else rz)(rng.uniform(0, 6.28)), [rng.randrange(qubits)]))
+        else:
+            ops.append((CX, rng.sample(range(qubits), 2)))
+    return ops
+
+def random_pauli(rng, qubits):
+    pauli = "".join(rng.choice("IXYZ") for _ in range(qubits))
+    return pauli if set(pauli) != {"I"} else "Z"+pauli[1:]
+
+def apply(state, qubits, matrix, targets):
+    k = len(targets)
+    state = np.tensordot(matrix.reshape([2]*(2*k)), state.reshape([2]*qubits), axes=(list(range(k, 2*k)), targets))
+    return np.moveaxis(state, list(range(k)), targets).reshape(-1)
+
+def expectation(ops, qubits, pauli):
+    state = np.zeros(2**qubits, dtype=complex)
+    state[0] = 1
+    for matrix, targets in ops:
+        state = apply(state, qubits, matrix, targets)
+    observable = np.array([[1]])
+    for p in pauli:
+        observable = np.kron(observable, PAULIS[p])
+    return float((state.conj() @ observable @ state).real)
+
+class NumpyFragments:
+    '''Replaces qiskit_tool.prepare_cut: the circuit is a tuple (ops, qubits) and the QASM of each fragment variation is a key of the
+    variations, simulated by value().'''
+
+    def __init__(self, qiskit_tool):
+        self.qiskit_tool = qiskit_tool
+        self.variations = {}
+
+    def prepare_cut(self, circuit, observable_string):
+        qt = self.qiskit_tool
+        ops, qubits = circuit
+        terms = qt.observable_terms(observable_string)
+        constant = sum(coeff for coeff, pauli in terms if set(pauli) == {"I"})
+        terms = [(coeff, pauli) for coeff, pauli in terms if set(pauli) != {"I"}]
+        fragments, cuts, candidate = qt.search_cut(ops, qubits)
+        measured = {}
+        for fragment in fragments:
+            fragment["prepared"] = {k: fragment["local"][cuts[k][1]] for k in fragment["incoming"]}
+            for k in fragment["outgoing"]:
+                measured[k] = fragment["local"][cuts[k][0]]
+        circuits = []
+        fragments_circuits = []
+        for fragment in fragments:
+            fragments_circuits.append(list(range(len(circuits), len(circuits)+len(qt.PREPARATIONS)**len(fragment["incoming"]))))
+            #same order of the variations of qiskit_tool.fragment_circuits
+            for preparation in product(range(len(qt.PREPARATIONS)), repeat=len(fragment["incoming"])):
+                prepared = []
+                for k, p in zip(fragment["incoming"], preparation):
+                    prepared += [(PREPARATION_MATRICES[gate], [fragment["prepared"][k]]) for gate in qt.PREPARATION_GATES[qt.PREPARATIONS[p]]]
+                key = f"variation {len(self.variations)}"
+                self.variations[key] = (prepared + fragment["ops"], len(fragment["segments"]))
+                circuits.append(key)
+        return fragments, cuts, candidate, measured, circuits, fragments_circuits, terms, constant
+
+    def value(self, key, observable, shots=None, rng=None):
+        #exact expected value, or its estimate from the outcomes (+1 or -1) of the shots
+        value = expectation(*self.variations[key], observable)
+        if shots is None:
+            return value
+        return 2*rng.binomial(shots, min(max((1+value)/2, 0.0), 1.0))/shots - 1
+
+def cutting_tool():
+    import qiskit_tool
+    fragments = NumpyFragments(qiskit_tool)
+    qiskit_tool.prepare_cut = fragments.prepare_cut
+    return qiskit_tool, fragments
+
+def check_sew(seed, runs):
+    qt, fragments = cutting_tool()
+    rng = random.Random(seed)
+    max_error = 0.0
+    cases = 0
+    for _ in range(runs):
+        qubits = rng.randint(3, 6)
+        ops = random_ops(rng, qubits, rng.randint(5, 25))
+        observable = {random_pauli(rng, qubits): 1.0, random_pauli(rng, qubits): -0.5, "I"*qubits: 0.25}
+        exact = sum(coeff*expectation(ops, qubits, pauli) for coeff, pauli in qt.observable_terms(observable))
+        for width in range(2, qubits+1):
+            qt.max_width = width
+            output, sew_data, _ = qt.cut((ops, qubits), observable)
+            values = {(key, obs): fragments.value(key, obs) for key, observables in output for obs in observables}
+            max_error = max(max_error, abs(qt.sew(values, sew_data) - exact))
+            cases += 1
+    qt.max_width = None
+    return {"ok": max_error < 1e-9, "cases": cases, "max_error": max_error}
+
+def check_sampled(seed, runs, shots=4000):
+    qt, fragments = cutting_tool()
+    rng = random.Random(seed)
+    qubits = 3
+    qt.max_width = 2
+    #a circuit with one or two cuts and a clearly non-zero expected value, the standard error grows as 6**cuts
+    while True:
+        ops = random_ops(rng, qubits, 8)
+        observable = {random_pauli(rng, qubits): 1.0, random_pauli(rng, qubits): 0.5}
+        exact = sum(coeff*expectation(ops, qubits, pauli) for coeff, pauli in qt.observable_terms(observable))
+        if 1 <= len(qt.search_cut(ops, qubits)[1]) <= 2 and abs(exact) > 0.2:
+            break
+    estimates = []
+    errors = []
+    num_cuts = None
+    for run in range(runs):
+        output, sew_data, cut_info, variation_shots = qt.cut_sampled((ops, qubits), observable, shots, seed + run)
+        num_cuts = cut_info["num_cuts"]
+        shot_rng = np.random.default_rng(seed + run)
+        values = {(key, obs): fragments.value(key, obs, variation_shots[(key, obs)], shot_rng) for key, observables in output for obs in observables}
+        estimate, standard_error = qt.sew_sampled(values, sew_data)
+        estimates.append(estimate)
+        errors.append(standard_error)
+    qt.max_width = None
+    mean = float(np.mean(estimates))
+    spread = float(np.std(estimates, ddof=1))
+    #the mean of the runs must be within 4 standard errors of the exact value, the reported error within 30% of the spread of the runs
+    z = (mean - exact) / (spread / np.sqrt(runs))
+    error_ratio = float(np.mean(errors)) / spread
+    return {"ok": num_cuts > 0 and abs(z) < 4 and 0.7 < error_ratio < 1.3, "num_cuts": num_cuts, "exact": exact, "mean": mean,
+            "z": float(z), "error_ratio": error_ratio}
+
+def check_binpacking(seed, runs):
+    from qukit import VirtualCircuit
+    from policies.sw_binpacking_policies import split_fragments
+    rng = random.Random(seed)
+    failures = []
+    for run in range(runs):
+        backends = [("provider", f"backend {b}") for b in range(rng.randint(1, 5))]
+        vcs_shots = []
+        for f in range(rng.randint(1, 30)):
+            stats = {"qubits": rng.randint(1, 8), "num_gates": rng.randint(1, 100)}
+            vcs_shots.append((VirtualCircuit(f"fragment {f}", {"stats": stats}), rng.choice([0, 1, 2, rng.randint(1, 10000)])))
+        assignments, coefficients = split_fragments(backends, vcs_shots)
+        assigned = {}
+        pairs = set()
+        for fragment, provider, backend, shots in assignments:
+            assigned[fragment.circuit] = assigned.get(fragment.circuit, 0) + shots
+            if (fragment.circuit, backend) in pairs:
+                failures.append((run, fragment.circuit, "assigned twice to", backend))
+            pairs.add((fragment.circuit, backend))
+        for fragment, shots in vcs_shots:
+            if assigned.get(fragment.circuit, 0) != shots:
+                failures.append((run, fragment.circuit, shots, assigned.get(fragment.circuit, 0)))
+        total = sum(share for provider in coefficients for share in coefficients[provider].values())
+        if any(shots for _, shots in vcs_shots) and abs(total - 1) > 1e-9:
+            failures.append((run, "coefficients", total))
+    return {"ok": not failures, "runs": runs, "failures": failures[:10]}
+
+class StubResult:
+    def get_counts(self):
+        return {"00": 1}
+
+class StubJob:
+    def __init__(self, backend, circuit, delay):
+        self.backend = backend
+        self.circuit = circuit
+        self.delay = delay
+        self.queue_time = 0.0
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self.backend.cancelled.append(self.circuit)
+        self._cancelled.set()
+
+    def result(self):
+        #a cancelled job has no result, as a job cancelled on a provider
+        if self._cancelled.wait(self.delay):
+            return None
+        return StubResult()
+
+class StubBackend:
+    '''Backend whose jobs take delay seconds, except the stalled-th one that takes SPECULATIVE_STALL seconds unless it is cancelled.'''
+
+    def __init__(self, name, delay, stalled=None):
+        self.name = name
+        self.delay = delay
+        self.stalled = stalled
+        self.submitted = 0
+        self.cancelled = []
+
+    def run(self, circuit, shots, **options):
+        self.submitted += 1
+        return StubJob(self, circuit, SPECULATIVE_STALL if self.submitted == self.stalled else self.delay)
+
+def check_speculative(seed, runs):
+    import qukit
+    failures = []
+    elapsed = []
+    for run in range(runs):
+        stalled = random.Random(seed + run).randint(4, 7)
+        stubs = {"slow": StubBackend("slow", 0.02, stalled), "fast": StubBackend("fast", 0.02)}
+
+        class StubDispatcher(qukit.Dispatcher):
+            def _get_backend(self, provider, backend):
+                return stubs[backend]
+
+            def _get_options_fun(self, provider, backend):
+                return None
+
+        def virtual_circuit(i):
+            return qukit.VirtualCircuit(SPECULATIVE_QASM, {"circuit_name": f"circuit {i}", "stats": {"qubits": 2, "num_gates": 3}})
+        dispatch = {"stub": {"slow": [(virtual_circuit(i), 100) for i in range(8)], "fast": [(virtual_circuit(i), 100) for i in range(8, 10)]}}
+        start = perf_counter()
+        results = StubDispatcher(speculative=True).run(dispatch)
+        elapsed.append(perf_counter() - start)
+        names = {}
+        for backend, jobs in results["stub"].items():
+            for job in jobs:
+                result = job.results[0]
+                names[result.circuit.metadata["circuit_name"]] = (backend, result.info.get("speculated_from"))
+        straggler = f"circuit {stalled-1}"
+        if sorted(names) != sorted(f"circuit {i}" for i in range(10)) or sum(len(jobs) for jobs in results["stub"].values()) != 10:
+            failures.append((run, "jobs", sorted(names)))
+        if len(stubs["slow"].cancelled) != 1 or names.get(straggler) != ("fast", "stub/slow"):
+            failures.append((run, straggler, names.get(straggler), len(stubs["slow"].cancelled)))
+        if elapsed[-1] > SPECULATIVE_STALL/2:
+            failures.append((run, "waited for the stalled copy", elapsed[-1]))
+    return {"ok": not failures, "runs": runs, "max_elapsed": max(elapsed), "failures": failures}
+
+CHECKS = {"sew": check_sew, "sampled": check_sampled, "binpacking": check_binpacking, "speculative": check_speculative}
+RUNS = {"sew": 20, "sampled": 200, "binpacking": 200, "speculative": 3}
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--checks", nargs="+", choices=list(CHECKS), default=list(CHECKS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=None, help="runs of each check (default depends on the check)")
+    args = parser.parse_args()
+    ok = True
+    for name in args.checks:
+        report = CHECKS[name](args.seed, args.runs or RUNS[name])
+        ok = ok and report["ok"]
+        print(json.dumps({"check": name, **report}, default=str))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
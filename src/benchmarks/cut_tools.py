@@ -0,0 +1,112 @@
+'''
+Benchmark of the cutting tools: pennylane_tool against qiskit_tool on random circuits, sweeping the width (qubits) at fixed depth and the depth
+(layers) at fixed width. Each layer applies a random rotation to every qubit and CNOTs between random neighbouring pairs, so that the circuit
+is connected and must be cut. For each tool and circuit the time of cut() is reported together with the size of the cut it found.
+With --end-to-end each tool runs the whole pipeline (cut, execution and sew, see cutnshot.cutnshot) on the backends, and its stage times and
+result are reported as well.
+
+usage (from the src folder): python benchmarks/cut_tools.py [--tools pennylane_tool qiskit_tool] [--widths 4 6 8] [--depths 4 8 16]
+    [--fixed-width 6] [--fixed-depth 8] [--runs RUNS] [--seed SEED] [--output OUTPUT]
+    [--end-to-end] [--shots SHOTS] [--backends BACKENDS] [--shots-allocation MODULE] [--sw-policy MODULE]
+'''
+import json, os, sys, random, statistics, importlib
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def random_circuit(qubits, depth, seed):
+    rng = random.Random(seed)
+    lines = ['OPENQASM 2.0;', 'include "qelib1.inc";', f'qreg q[{qubits}];', f'creg c[{qubits}];']
+    for _ in range(depth):
+        for q in range(qubits):
+            lines.append(f'{rng.choice(["rx", "ry", "rz"])}({rng.uniform(0, 6.28):.6f}) q[{q}];')
+        for q in range(rng.randrange(2), qubits-1, 2):
+            lines.append(f'cx q[{q}],q[{q+1}];')
+    lines.append('measure q -> c;')
+    return "\n".join(lines)+"\n"
+
+def run_tool(module, circuit, observable, runs):
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        try:
+            _, _, cut_info = module.cut(circuit, observable)
+        except Exception as e:  # pylint: disable=broad-except
+            return {"error": repr(e)}
+        times.append(perf_counter() - start)
+    return {
+        "time_cut_median": statistics.median(times),
+        "time_cut_min": min(times),
+        "num_cuts": cut_info.get("num_cuts"),
+        "num_fragments": cut_info.get("num_fragments"),
+        "max_fragment_qubits": max(cut_info.get("fragments_qubits", [0])),
+        "num_variations": cut_info.get("num_variations"),
+    }
+
+def run_pipeline(module, circuit, observable, pipeline):
+    #pipeline: shots, backends and policy modules of the end-to-end run
+    import cutnshot
+    try:
+        output = cutnshot.cutnshot(circuit, observable, pipeline["shots"], pipeline["backends"], module,
+            pipeline["shots_allocation"], pipeline["sw_policy"], {"times_flag": True})
+    except Exception as e:  # pylint: disable=broad-except
+        return {"error": repr(e)}
+    return {"result": float(output["results"]), "times": output["times"]}
+
+def sweep(tools, points, runs, seed, pipeline=None):
+    results = []
+    for qubits, depth in points:
+        circuit = random_circuit(qubits, depth, seed)
+        sample = {"qubits": qubits, "depth": depth}
+        for name, module in tools.items():
+            sample[name] = run_tool(module, circuit, "Z"*qubits, runs)
+            if pipeline is not None and "error" not in sample[name]:
+                sample[name]["end_to_end"] = run_pipeline(module, circuit, "Z"*qubits, pipeline)
+        print(json.dumps(sample), file=sys.stderr)
+        results.append(sample)
+    return results
+
+
+def main():
+    parser = ArgumentParser(prog='cut_tools.py', description='Benchmark of the cutting tools on width and depth sweeps.')
+    parser.add_argument('--tools', type=str, nargs='+', help='Cutting modules to compare.', default=["pennylane_tool", "qiskit_tool"])
+    parser.add_argument('--widths', type=int, nargs='+', help='Qubits of the width sweep.', default=[4, 6, 8, 10, 12])
+    parser.add_argument('--depths', type=int, nargs='+', help='Layers of the depth sweep.', default=[4, 8, 16, 32, 64])
+    parser.add_argument('--fixed-width', type=int, help='Qubits of the depth sweep.', default=6)
+    parser.add_argument('--fixed-depth', type=int, help='Layers of the width sweep.', default=8)
+    parser.add_argument('--runs', '-r', type=int, help='Cuts of each circuit per tool.', default=3)
+    parser.add_argument('--seed', type=int, help='Seed of the random circuits.', default=0)
+    parser.add_argument('--output', '-o', type=str, help='File where the report is written, printed if not given.', default=None)
+    parser.add_argument('--end-to-end', help='Run also the whole pipeline (cut, execution and sew) with each tool.', action='store_true')
+    parser.add_argument('--shots', type=int, help='Shots of the end-to-end runs.', default=8000)
+    parser.add_argument('--backends', type=str, help='JSON list of [provider, backend] of the end-to-end runs.', default='[["ibm_aer", "aer.perfect"]]')
+    parser.add_argument('--shots-allocation', type=str, help='Shots allocation module of the end-to-end runs.', default="policies.qubit_proportional")
+    parser.add_argument('--sw-policy', type=str, help='Shot-wise policy module of the end-to-end runs.', default="policies.sw_fair_policies")
+    args = parser.parse_args()
+
+    tools = {name: importlib.import_module(name) for name in args.tools}
+    pipeline = None
+    if args.end_to_end:
+        pipeline = {
+            "shots": args.shots,
+            "backends": json.loads(args.backends),
+            "shots_allocation": importlib.import_module(args.shots_allocation),
+            "sw_policy": importlib.import_module(args.sw_policy),
+        }
+    report = {
+        "runs": args.runs,
+        "seed": args.seed,
+        "width_sweep": sweep(tools, [(w, args.fixed_depth) for w in args.widths], args.runs, args.seed, pipeline),
+        "depth_sweep": sweep(tools, [(args.fixed_width, d) for d in args.depths], args.runs, args.seed, pipeline),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+'''
+Benchmark of the start-up time of the Cut&Shoot command line tool.
+Each sample runs a fresh interpreter that imports the CLI and parses a configuration file, i.e. all the work done
+before the pipeline starts cutting. The heavy frameworks loaded during the start-up are reported as well, since
+they are expected to be imported only when the configured backends and modules need them: the benchmark exits with
+status 1 if any of them is loaded.
+
+usage (from the src folder): python benchmarks/startup.py [--runs RUNS] [--configfile CONFIGFILE]
+'''
+import json, os, subprocess, sys, statistics
+from argparse import ArgumentParser
+from time import perf_counter
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["numpy", "qiskit", "qiskit_aer", "qiskit_ibm_runtime", "pennylane", "pennylane_qiskit", "kahypar"]
+
+STARTUP_SCRIPT = '''
+import sys, json, configparser
+from time import perf_counter
+start = perf_counter()
+import main
+config = configparser.ConfigParser()
+config.read(sys.argv[1])
+settings = config["SETTINGS"]
+end = perf_counter()
+heavy = [m for m in sys.argv[2].split(",") if m in sys.modules]
+print(json.dumps({"time_import": end - start, "heavy_modules": heavy}))
+'''
+
+
+def run_sample(configfile):
+    start = perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT, configfile, ",".join(HEAVY_MODULES)],
+        cwd=SRC_DIR, capture_output=True, text=True, check=True
+    )
+    end = perf_counter()
+    sample = json.loads(out.stdout.strip().splitlines()[-1])
+    sample["time_process"] = end - start
+    return sample
+
+
+def main():
+    parser = ArgumentParser(prog='startup.py', description='Benchmark of the start-up time of main.py.')
+    parser.add_argument('--runs', '-r', type=int, help='Number of fresh interpreters to start.', default=10)
+    parser.add_argument('--configfile', '-c', type=str, help='Configuration file .ini.', default="config.ini")
+    args = parser.parse_args()
+
+    samples = [run_sample(args.configfile) for _ in range(args.runs)]
+    import_times = [s["time_import"] for s in samples]
+    process_times = [s["time_process"] for s in samples]
+    report = {
+        "runs": args.runs,
+        "time_import_median": statistics.median(import_times),
+        "time_import_max": max(import_times),
+        "time_process_median": statistics.median(process_times),
+        "time_process_max": max(process_times),
+        "heavy_modules": sorted({m for s in samples for m in s["heavy_modules"]}),
+    }
+    print(json.dumps(report, indent=4))
+    if report["heavy_modules"]:
+        print(f"Heavy modules loaded during the start-up: {', '.join(report['heavy_modules'])}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
-from qukit import Dispatcher, QukitJSONEncoder, VirtualCircuit
-import logging, datetime, multiprocessing, json, os
-from time import process_time, perf_counter
+from qukit import Dispatcher, QukitJSONEncoder, VirtualCircuit, LazyVirtualCircuit
+import logging, datetime, multiprocessing, json, os, tempfile, shutil, importlib, math
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import wait
+from time import process_time, perf_counter, sleep
 import utils as utils
+from agents import RemoteDispatcher
+import governor
+import ledger
 
 TIME_CUTTING = "time_cutting"
+TIME_PREPROCESSING = "time_preprocessing"
 TIME_ALLOCATION = "time_allocation"
 TIME_DISPATCH = "time_dispatch"
 TIME_EXECUTION = "time_execution"
@@ -16,31 +22,46 @@ TIME_SEW = "time_sew"
 TIME_TOTAL = "time_total"
 TIME_EXECUTION_RETRIES = "time_execution_retries"
 
+#chunks of fragment variations given to each process of the preprocessing
+PREPROCESSING_CHUNKS_PER_PROCESS = 4
+
+#restarts of the whole execution when a job fails all its attempts (see qukit.run_job), with an exponential backoff
+MAX_EXECUTION_ATTEMPTS = 3
+EXECUTION_RETRY_BACKOFF = 1.0
+
 # create logger
 logger = logging.getLogger("cutnshot")
 logging.basicConfig(level=logging.ERROR)
 logger.setLevel(logging.INFO)
 
-def single_execution(i,dispatch, string):
-    dispatcher = Dispatcher()
+def single_execution(path, dispatch, string, dispatcher_options):
+    dispatcher = Dispatcher(**dispatcher_options)
     print(f"Executing a process as machine {string} "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     execution_results = dispatcher.run(dispatch)
-    with open(f"./temp/{i}.json", "w") as f:
+    with open(path, "w") as f:
         json.dump(execution_results, f, cls=QukitJSONEncoder)
 
-def parallel_execution(dispatch, times):
+def parallel_execution(dispatch, times, dispatcher_options, max_processes=None):
     processes = []
+    running = []
     if not os.path.exists("./temp"):
         os.makedirs("./temp")
+    #one folder per run, so that concurrent runs (e.g. in service mode) do not overwrite each other's results
+    temp_dir = tempfile.mkdtemp(dir="./temp")
     start = process_time()
     i=0
     for provider in dispatch:
         for backend in dispatch[provider]:
             arg = {provider: {backend: dispatch[provider][backend]}}
             string = f"{provider}_{backend}"
-            p = multiprocessing.Process(target=single_execution, args=(i,arg,string))
+            p = multiprocessing.Process(target=single_execution, args=(os.path.join(temp_dir, f"{i}.json"),arg,string,dispatcher_options))
             processes.append(p)
+            if max_processes and len(running) >= max_processes:
+                #wait for the first process to finish, so that at most max_processes run at the same time
+                finished = wait([r.sentinel for r in running])
+                running = [r for r in running if r.sentinel not in finished]
             p.start()
+            running.append(p)
             i+=1
     for p in processes:
         p.join()
@@ -50,21 +71,233 @@ def parallel_execution(dispatch, times):
     single_res = {}
     start = process_time()
     for j in range(0,i):
-        with open(f"./temp/{j}.json", "r") as f:
+        with open(os.path.join(temp_dir, f"{j}.json"), "r") as f:
             dict = json.load(f, object_hook=QukitJSONEncoder.decode)
         for backend in dict:
             if backend not in single_res:
                 single_res[backend] = {}
             single_res[backend].update(dict[backend])
-        os.remove(f"./temp/{j}.json")
+    shutil.rmtree(temp_dir)
 
     times = utils.record_time(times, TIME_SYNCHRONIZATION, start)
     
     start = process_time()
     counts = utils.results_to_counts(single_res)
+    execution_info = utils.results_to_info(single_res)
     times = utils.record_time(times, TIME_COUNTS, start)
-    return counts, times
+    return counts, times, execution_info
+
+
+def preprocess_fragment(vc):
+    #push of the observable of a fragment variation, with its stats computed once for the allocation
+    new_vc = utils.push_obs(vc)
+    new_vc.metadata["stats"] = new_vc.describe()
+    return new_vc
+
+def prepare_fragments(cut_output, processes=None):
+    vcs = utils.fragments_to_vc(cut_output)
+
+    if processes and processes > 1 and len(vcs) > 1:
+        #a few chunks per process balance the load without sending the variations one at a time, map keeps their order
+        chunksize = max(1, math.ceil(len(vcs) / (processes*PREPROCESSING_CHUNKS_PER_PROCESS)))
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pushed_vcs = list(executor.map(preprocess_fragment, vcs, chunksize=chunksize))
+    else:
+        pushed_vcs = [preprocess_fragment(vc) for vc in vcs]
+
+    new_vcs = []
+    old_vcs = {}
+    for vc, new_vc in zip(vcs, pushed_vcs):
+        new_vcs.append(new_vc)
 
+        new_name = new_vc.metadata["circuit_name"]
+        old_vc = vc.circuit
+        old_vcs[new_name] = old_vc
+    return new_vcs, old_vcs
+
+def prepare_deferred_fragments(variations):
+    #variations of a cut with deferred QASM export (see pennylane_tool.cut_deferred): no QASM is produced, the circuits are named by the hash of the keys
+    #of the cutting tool; the variations are all needed by the allocation, only their QASM export is deferred
+    vcs = []
+    old_vcs = {}
+    cut_output = []
+    for key, qasm_fun, obs, stats in variations:
+        name = utils.hash_circuit(key)
+        metadata = {"circuit_name": name, "qubits": len(obs), "observable": obs, "stats": stats}
+        vcs.append(LazyVirtualCircuit(qasm_fun, metadata))
+        old_vcs[name] = key
+        cut_output.append((key, [obs]))
+    return vcs, old_vcs, cut_output
+
+def schedule_exports(dispatch):
+    #schedules the QASM export of the lazy circuits of the dispatch in their order of execution, the export thread produces them while the
+    #backends execute the previous ones (see qukit.export_executor); an error of the export is raised by the execution of the circuit
+    queues = [dispatch[provider][backend] for provider in dispatch for backend in dispatch[provider]]
+    for i in range(max([len(queue) for queue in queues], default=0)):
+        for queue in queues:
+            if i < len(queue) and isinstance(queue[i][0], LazyVirtualCircuit):
+                queue[i][0].materialize()
+
+def get_dispatcher_options(input_flags, resources=None):
+    #options of the qukit.Dispatcher set by the input flags and by the resource governor
+    options = {}
+    if resources:
+        options["workers"] = resources["dispatcher_workers"]
+        options["aer_options"] = resources["aer_options"]
+    if input_flags and "shot_chunk_size" in input_flags:
+        options["shot_chunk_size"] = input_flags["shot_chunk_size"]
+    if input_flags and "auto_simulation_method" in input_flags:
+        options["auto_simulation_method"] = input_flags["auto_simulation_method"]
+    if input_flags and "emulated_backends" in input_flags:
+        options["emulated_backends"] = input_flags["emulated_backends"]
+    if input_flags and input_flags.get("speculative_flag"):
+        options["speculative"] = True
+        if "straggler_factor" in input_flags:
+            options["straggler_factor"] = input_flags["straggler_factor"]
+        calibration = get_calibration(input_flags)
+        if calibration:
+            options["calibration"] = calibration
+    return options
+
+def get_agent_options(input_flags):
+    #timeouts of the agents of the RemoteDispatcher (see agents.py)
+    options = {}
+    if input_flags and "agent_timeout" in input_flags:
+        options["timeout"] = input_flags["agent_timeout"]
+    if input_flags and "agent_job_timeout" in input_flags:
+        options["job_timeout"] = input_flags["agent_job_timeout"]
+    return options
+
+def supported_flag(input_flags, flag, cut_strategy_module, function):
+    #the modes implemented by some cutting tools only, the others run the exact cut
+    if not (input_flags and input_flags.get(flag, False)):
+        return False
+    if not hasattr(cut_strategy_module, function):
+        logger.warning("%s is ignored, the cutting tool %s does not implement %s", flag, cut_strategy_module.__name__, function)
+        return False
+    return True
+
+def get_calibration(input_flags):
+    #time model of the jobs of each backend (see planner.py): the calibration file of the configuration, otherwise the one fitted on the ledger
+    if input_flags.get("plan_calibration"):
+        import planner
+        return planner.load_calibration(input_flags["plan_calibration"])
+    if input_flags.get("ledger") and os.path.exists(input_flags["ledger"]):
+        try:
+            return ledger.calibration(input_flags["ledger"])
+        except Exception:  # pylint: disable=broad-except
+            #the straggler estimates fall back to the uncalibrated model
+            logger.exception("The planner calibration could not be fitted on the ledger")
+    return None
+
+def governed(input_flags):
+    #the governor is enabled by main.py and the service (input_flags["governor"]), library calls size every layer on the whole machine
+    #with agents the jobs run on other hosts, the local cores are not governed
+    return bool(input_flags and input_flags.get("governor") and not input_flags.get("agents"))
+
+def get_pool_processes(input_flags, processes=None):
+    #processes of the pools before the execution, limited by the governor to the cores of the run
+    if not governed(input_flags):
+        return processes
+    return governor.pool_processes(processes, input_flags.get("resources", {}).get("cores") if input_flags else None)
+
+def get_resources(dispatch, input_flags, parallel_execution_flag):
+    if not governed(input_flags):
+        return None
+    resource_options = input_flags.get("resources", {}) if input_flags else {}
+    return governor.allocate(dispatch, parallel_execution_flag, **resource_options)
+
+def execute(dispatch, times, parallel_execution_flag, dispatcher_options=None, agents=None, processes=None, agent_options=None):
+    if dispatcher_options is None:
+        dispatcher_options = {}
+    if agents or not parallel_execution_flag:
+        #retry when IBM fails
+        time_execution_retries = 0.0
+        retry = True
+        attempt = 0
+        while(retry):
+            attempt += 1
+            #with agents, the jobs are executed by the remote agents (see agents.py)
+            dispatcher = RemoteDispatcher(agents, options=dispatcher_options, **(agent_options or {})) if agents else Dispatcher(**dispatcher_options)
+            #Execute the dispatch
+            logger.info(f"Executing "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))       
+            if agents:
+                #the coordinator waits on the agents: the time is wall-clock
+                start = perf_counter()
+                execution_results = dispatcher.run(dispatch)
+                times[TIME_EXECUTION] = perf_counter() - start
+            else:
+                start = process_time()
+                execution_results = dispatcher.run(dispatch)
+                times = utils.record_time(times, TIME_EXECUTION, start)
+
+            #Counts calculation
+            logger.info(f"Calculating counts "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            start = process_time()
+            counts = utils.results_to_counts(execution_results)
+            execution_info = utils.results_to_info(execution_results)
+            times = utils.record_time(times, TIME_COUNTS, start)
+            if counts:
+                retry = False
+                times[TIME_EXECUTION_RETRIES] = time_execution_retries
+            elif attempt >= MAX_EXECUTION_ATTEMPTS:
+                raise RuntimeError(f"The execution failed {attempt} times")
+            else:
+                logger.info("IBM has filed :( restarting the execution at "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                time_execution_retries += times[TIME_EXECUTION]
+                sleep(EXECUTION_RETRY_BACKOFF * 2**(attempt-1))
+    else:
+        time_execution_retries = 0.0
+        attempt = 1
+        counts, times, execution_info = parallel_execution(dispatch, times, dispatcher_options, processes)
+        while not counts:
+            if attempt >= MAX_EXECUTION_ATTEMPTS:
+                raise RuntimeError(f"The execution failed {attempt} times")
+            logger.info("IBM has filed :( restarting the execution at "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            time_execution_retries += times[TIME_EXECUTION]
+            sleep(EXECUTION_RETRY_BACKOFF * 2**(attempt-1))
+            attempt += 1
+            counts, times, execution_info = parallel_execution(dispatch, times, dispatcher_options, processes)
+        times[TIME_EXECUTION_RETRIES] = time_execution_retries
+    return counts, times, execution_info
+
+def record_ledger(input_flags, params, times, cut_info, num_jobs, execution_info, result):
+    #appends the run to the ledger given in the input flags, if any (see ledger.py)
+    if not input_flags or not input_flags.get("ledger"):
+        return
+    error = None
+    if "perf_exp_val" in input_flags:
+        error = [input_flags["perf_exp_val"]-r for r in result] if isinstance(result, list) else input_flags["perf_exp_val"]-result
+    try:
+        ledger.record_run(input_flags["ledger"], params, times, cut_info, num_jobs, execution_info, result, error)
+    except Exception:  # pylint: disable=broad-except
+        #the ledger must not make a completed run fail
+        logger.exception("The run could not be recorded in the ledger")
+
+def cut_worker(cut_strategy_name, circuit, observable_string, search_processes=None):
+    cut_strategy_module = importlib.import_module(cut_strategy_name)
+    if search_processes is not None and hasattr(cut_strategy_module, "processes"):
+        cut_strategy_module.processes = search_processes
+    return cut_strategy_module.cut(circuit, observable_string)
+
+def cut_circuits(circuits, observables, cut_strategy_module, processes=None):
+    #cuts are independent, each circuit is cut in its own process (the cut module is imported by name in the workers)
+    if len(circuits) == 1:
+        return [cut_strategy_module.cut(circuits[0], observables[0])]
+    #the cutting tools that search the cut in a pool of their own (e.g. pennylane_search_tool) share the processes of the batch
+    search_processes = max(1, processes // min(len(circuits), processes)) if processes else None
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(cut_worker, [cut_strategy_module.__name__]*len(circuits), circuits, observables, [search_processes]*len(circuits)))
+
+
+def open_stats_spill(input_flags):
+    #in low-memory mode the stats are spilled to a JSON-lines file (see utils.StatsSpill)
+    if not input_flags or not input_flags.get("stats_flag") or not input_flags.get("low_memory_flag"):
+        return None
+    stats_file = input_flags.get("stats_file", None)
+    if stats_file is None:
+        _, stats_file = tempfile.mkstemp(prefix="stats_", suffix=".jsonl")
+    return utils.StatsSpill(stats_file)
 
 def cutnshot(
     circuit,
@@ -77,6 +310,26 @@ def cutnshot(
     input_flags = None,
     metadata = None
     ):
+    spill = open_stats_spill(input_flags)
+    try:
+        return run_cutnshot(circuit, observable_string, shots, provider_backend_couples, cut_strategy_module, shots_allocation_module, sw_policy_module, input_flags, metadata, spill)
+    finally:
+        #the stats file is closed also when the run fails
+        if spill:
+            spill.close()
+
+def run_cutnshot(
+    circuit,
+    observable_string,
+    shots,
+    provider_backend_couples,
+    cut_strategy_module,
+    shots_allocation_module, 
+    sw_policy_module,
+    input_flags = None,
+    metadata = None,
+    spill = None
+    ):
     if input_flags is None:
         times_flag = False
         stats_flag = False
@@ -89,6 +342,15 @@ def cutnshot(
         parallel_execution_flag = input_flags["parallel_execution_flag"] if "parallel_execution_flag" in input_flags else False
         if "verbose" in input_flags and input_flags["verbose"]:
             logger.setLevel(logging.DEBUG)
+    #low-memory mode: the data of each stage is released once the next stages do not need it, the fragments are referred to by hash
+    #and the stats are written to disk as they are produced
+    low_memory_flag = input_flags.get("low_memory_flag", False) if input_flags else False
+    #deferred QASM export: the cutting tool gives the variations with their stats, their QASM is exported while the execution runs
+    deferred_qasm_flag = supported_flag(input_flags, "deferred_qasm_flag", cut_strategy_module, "cut_deferred")
+    #sampled sewing: the cutting tool samples the terms of the decomposition, each shot goes to the variations of a sampled term (see qiskit_tool.cut_sampled)
+    sampling_flag = supported_flag(input_flags, "sampling_flag", cut_strategy_module, "cut_sampled")
+    if sampling_flag:
+        deferred_qasm_flag = False
 
     times = {}
 
@@ -112,91 +374,134 @@ def cutnshot(
     #cut
     logger.info(f"Cutting "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     start = process_time()
-    cut_res = cut_strategy_module.cut(circuit, observable_string)
-    if len(cut_res)==3:
-        cut_output, sew_data, cut_info = cut_res
+    if sampling_flag:
+        cut_res = cut_strategy_module.cut_sampled(circuit, observable_string, shots, input_flags.get("sampling_seed"))
+        cut_output, sew_data, cut_info, variation_shots = cut_res
+        #the shots of the sampled variations, keyed as the vcs
+        sampled_shots = {(utils.hash_circuit(qasm), obs): n for (qasm, obs), n in variation_shots.items()}
     else:
-        cut_output, sew_data = cut_res
-        cut_info = None
+        cut_res = cut_strategy_module.cut_deferred(circuit, observable_string) if deferred_qasm_flag else cut_strategy_module.cut(circuit, observable_string)
+        if len(cut_res)==3:
+            cut_output, sew_data, cut_info = cut_res
+        else:
+            cut_output, sew_data = cut_res
+            cut_info = None
     times = utils.record_time(times, TIME_CUTTING, start)
 
+    #preprocessing of the fragments, possibly in parallel: the time is wall-clock
+    start = perf_counter()
+    if deferred_qasm_flag:
+        vcs, old_vcs, cut_output = prepare_deferred_fragments(cut_output)
+    else:
+        vcs, old_vcs = prepare_fragments(cut_output, get_pool_processes(input_flags, input_flags.get("preprocessing_processes")) if input_flags and input_flags.get("preprocessing_processes") else None)
+    times[TIME_PREPROCESSING] = perf_counter() - start
     logger.debug(f"Cut info: {cut_info}")
-
-    vcs = utils.fragments_to_vc(cut_output)
-
-    new_vcs = []
-    old_vcs = {}
-    for vc in vcs:
-        new_vc = utils.push_obs(vc)
-        new_vcs.append(new_vc)
-
-        new_name = new_vc.metadata["circuit_name"]
-        old_vc = vc.circuit
-        old_vcs[new_name] = old_vc
-    vcs = new_vcs
+    if low_memory_flag:
+        if spill:
+            spill.write("circuit_stats", VirtualCircuit(circuit, {}).describe())
+            spill.write("cut_info", cut_info)
+            if deferred_qasm_flag:
+                for vc in vcs:
+                    spill.write("cut_output", (vc.metadata["circuit_name"], [vc.metadata["observable"]], vc.describe()), vc.metadata["circuit_name"]+vc.metadata["observable"])
+            else:
+                for circ, obs in cut_output:
+                    spill.write("cut_output", (circ, obs, VirtualCircuit(circ, {}).describe()), utils.hash_circuit(circ))
+        #the expected values and the sew data are keyed by the hash of the fragments, their QASM is kept only by the circuits to execute
+        del cut_res, cut_output, old_vcs
+        sew_data = utils.hash_fragments(sew_data)
 
     #Allocation of shots
     logger.info(f"Allocating shots "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     start = process_time()
-    vcs_shots = shots_allocation_module.allocate_shots(vcs, shots)
+    if sampling_flag:
+        vcs_shots = [(vc, sampled_shots[(vc.metadata["circuit_name"], vc.metadata["observable"])]) for vc in vcs]
+    else:
+        vcs_shots = shots_allocation_module.allocate_shots(vcs, shots)
 
     times = utils.record_time(times, TIME_ALLOCATION, start)
 
     #split
     logger.info(f"Splitting "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     start = process_time()
-    dispatch, split_coefficients = utils.create_dispatch(vcs_shots, provider_backend_couples, sw_policy_module.split)
+    dispatch, split_coefficients = utils.create_policy_dispatch(vcs_shots, provider_backend_couples, sw_policy_module)
     times = utils.record_time(times, TIME_DISPATCH, start)
-
-    if not parallel_execution_flag:
-        #retry when IBM fails
-        time_execution_retries = 0.0
-        retry = True
-        while(retry):
-            dispatcher = Dispatcher()
-            #Execute the dispatch
-            logger.info(f"Executing "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))       
-            start = process_time()
-            execution_results = dispatcher.run(dispatch)
-            times = utils.record_time(times, TIME_EXECUTION, start)
-
-            #Counts calculation
-            logger.info(f"Calculating counts "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-            start = process_time()
-            counts = utils.results_to_counts(execution_results)
-            times = utils.record_time(times, TIME_COUNTS, start)
-            if counts:
-                retry = False
-                times[TIME_EXECUTION_RETRIES] = time_execution_retries
-            else:
-                logger.info("IBM has filed :( restarting the execution at "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-                time_execution_retries += times[TIME_EXECUTION]
-    else:
-        counts, times = parallel_execution(dispatch, times)
+    num_jobs = sum(len(dispatch[provider][backend]) for provider in dispatch for backend in dispatch[provider])
+    if low_memory_flag:
+        del vcs, vcs_shots
+        if spill:
+            for provider in dispatch:
+                for backend in dispatch[provider]:
+                    spill.write("dispatch", [(vc.metadata["circuit_name"], vc.metadata["observable"], vc_shots) for vc, vc_shots in dispatch[provider][backend]], f"{provider}/{backend}")
+
+    resources = get_resources(dispatch, input_flags, parallel_execution_flag)
+    if deferred_qasm_flag and (input_flags.get("agents") or not parallel_execution_flag):
+        #the circuits of the parallel execution are exported by its processes
+        schedule_exports(dispatch)
+    counts, times, execution_info = execute(dispatch, times, parallel_execution_flag, get_dispatcher_options(input_flags, resources), input_flags.get("agents") if input_flags else None, resources["processes"] if resources else None, get_agent_options(input_flags))
+    if low_memory_flag:
+        #the executed circuits are not needed anymore
+        del dispatch
+        if spill:
+            for provider in counts:
+                for backend in counts[provider]:
+                    spill.write("counts", counts[provider][backend], f"{provider}/{backend}")
+            spill.write("execution_info", execution_info)
+            spill.write("resources", resources)
 
     #merge 
     logger.info(f"Merging "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     start = process_time()
     probs, merge_coefficients =sw_policy_module.merge(counts) #probs = {(circuit_id,obs): {state: probability}}
     times = utils.record_time(times, TIME_MERGE, start)
+    if low_memory_flag:
+        del counts
+        if spill:
+            spill.write("split_coefficients", split_coefficients)
+            spill.write("merge_coefficients", merge_coefficients)
+            for k in probs:
+                spill.write("probs", probs[k], str(k))
     
     #expected values
     logger.info(f"Expected values "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     start = process_time()
     
-    qasm_obs_exp_values= utils.expected_values(probs, vcs, old_vcs)
+    if low_memory_flag:
+        exp_values = utils.expected_values_by_hash(probs)
+        del probs
+        qasm_obs_exp_values = utils.HashKeyedValues(exp_values)
+    else:
+        qasm_obs_exp_values= utils.expected_values(probs, vcs, old_vcs)
     
     times = utils.record_time(times, TIME_EXPECTED_VALUES, start)
 
     #sew
     logger.info(f"Sewing "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     start = process_time()
-    final_result = cut_strategy_module.sew(qasm_obs_exp_values, sew_data)
+    standard_error = None
+    if sampling_flag:
+        final_result, standard_error = cut_strategy_module.sew_sampled(qasm_obs_exp_values, sew_data)
+    else:
+        final_result = cut_strategy_module.sew(qasm_obs_exp_values, sew_data)
     times = utils.record_time(times, TIME_SEW, start)
+    if spill:
+        for k in exp_values:
+            spill.write("exp_values", exp_values[k], str(k))
 
     end_time = perf_counter()
     times[TIME_TOTAL] = end_time - initial_time
 
+    record_ledger(input_flags, {
+        "operation": "cc_sw",
+        "circuit": circuit,
+        "observable": observable_string,
+        "shots": shots,
+        "backends": provider_backend_couples,
+        "cut_strategy": cut_strategy_module.__name__,
+        "shots_allocation": shots_allocation_module.__name__,
+        "sw_policy": sw_policy_module.__name__,
+        "parallel_execution": parallel_execution_flag,
+    }, times, cut_info, num_jobs, execution_info, final_result)
+
     results = {}
 
 
@@ -214,10 +519,14 @@ def cutnshot(
             "metadata": metadata
         }
     results["results"] = final_result
+    if standard_error is not None:
+        results["standard_error"] = standard_error
 
     if times_flag: 
         results["times"]=  times
-    if stats_flag:
+    if spill:
+        results["stats"] = spill.close()
+    elif stats_flag:
 
         vc = VirtualCircuit(circuit, {})
         #fragments stats in cut_output
@@ -232,6 +541,8 @@ def cutnshot(
             "cut_output": cut_output,
             "dispatch": dispatch,
             "counts": counts,
+            "execution_info": execution_info,
+            "resources": resources,
             "probs": probs,
             "split_coefficients": split_coefficients,
             "merge_coefficients": merge_coefficients,
@@ -239,4 +550,154 @@ def cutnshot(
         }
 
 
-    return results
\ No newline at end of file
+    return results
+
+
+def cutnshot_batch(
+    circuits,
+    observables,
+    shots,
+    provider_backend_couples,
+    cut_strategy_module,
+    shots_allocation_module, 
+    sw_policy_module,
+    input_flags = None,
+    metadata = None
+    ):
+    #circuits: list of QASM circuits, observables: list with the observable of each circuit (or a single one for all of them)
+    if input_flags is None:
+        input_flags = {}
+    times_flag = input_flags["times_flag"] if "times_flag" in input_flags else False
+    stats_flag = input_flags["stats_flag"] if "stats_flag" in input_flags else False
+    params_flag = input_flags["params_flag"] if "params_flag" in input_flags else False
+    parallel_execution_flag = input_flags["parallel_execution_flag"] if "parallel_execution_flag" in input_flags else False
+    if "verbose" in input_flags and input_flags["verbose"]:
+        logger.setLevel(logging.DEBUG)
+    if utils.is_single_observable(observables):
+        observables = [observables]*len(circuits)
+    if len(observables) != len(circuits):
+        raise ValueError(f"{len(observables)} observables given for {len(circuits)} circuits")
+
+    times = {}
+
+    logger.info(f"Starting Cut_and_Shot on a batch of {len(circuits)} circuits "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    logger.debug(f"Shots per circuit: {shots}")
+    logger.debug(f"Cut Tool: {cut_strategy_module.__name__}")
+    logger.debug(f"Shots Allocation: {shots_allocation_module.__name__}")
+    logger.debug(f"Len Provider Backend Couple: {len(provider_backend_couples)}")
+    logger.debug(f"Shot-wise Policy: {sw_policy_module.__name__}")
+    logger.debug(f"Parallel Execution: {parallel_execution_flag}")
+    logger.debug(f"Metadata: {metadata}")
+
+    initial_time = perf_counter()
+
+    #cut, in parallel: the time is wall-clock since the work is done by other processes
+    logger.info(f"Cutting "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    start = perf_counter()
+    cut_results = cut_circuits(circuits, observables, cut_strategy_module, get_pool_processes(input_flags))
+    times[TIME_CUTTING] = perf_counter() - start
+
+    sew_datas = []
+    cut_infos = []
+    circuits_vcs = []
+    pooled = {}
+    requested_variations = 0
+    start = perf_counter()
+    for cut_res in cut_results:
+        if len(cut_res)==3:
+            cut_output, sew_data, cut_info = cut_res
+        else:
+            cut_output, sew_data = cut_res
+            cut_info = None
+        sew_datas.append(sew_data)
+        cut_infos.append(cut_info)
+        circuits_vcs.append(prepare_fragments(cut_output, get_pool_processes(input_flags, input_flags.get("preprocessing_processes")) if input_flags.get("preprocessing_processes") else None))
+    times[TIME_PREPROCESSING] = perf_counter() - start
+
+    start = process_time()
+    for vcs, old_vcs in circuits_vcs:
+        #Allocation of shots, each circuit has its own budget
+        vcs_shots = shots_allocation_module.allocate_shots(vcs, shots)
+        requested_variations += len(vcs_shots)
+        #identical fragment variations of different circuits are executed once, with the largest number of shots requested
+        for vc, vc_shots in vcs_shots:
+            key = (vc.metadata["circuit_name"], vc.metadata["observable"])
+            if key not in pooled or pooled[key][1] < vc_shots:
+                pooled[key] = (vc, vc_shots)
+    times = utils.record_time(times, TIME_ALLOCATION, start)
+    logger.debug(f"Fragment variations: {requested_variations} requested, {len(pooled)} executed")
+
+    #split, one global dispatch for the whole batch
+    logger.info(f"Splitting "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    start = process_time()
+    dispatch, split_coefficients = utils.create_policy_dispatch(list(pooled.values()), provider_backend_couples, sw_policy_module)
+    times = utils.record_time(times, TIME_DISPATCH, start)
+
+    resources = get_resources(dispatch, input_flags, parallel_execution_flag)
+    counts, times, execution_info = execute(dispatch, times, parallel_execution_flag, get_dispatcher_options(input_flags, resources), input_flags.get("agents") if input_flags else None, resources["processes"] if resources else None, get_agent_options(input_flags))
+
+    #merge 
+    logger.info(f"Merging "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    start = process_time()
+    probs, merge_coefficients =sw_policy_module.merge(counts)
+    times = utils.record_time(times, TIME_MERGE, start)
+
+    #expected values and sew, demultiplexed to each circuit
+    logger.info(f"Sewing "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    start = process_time()
+    final_results = []
+    all_exp_values = {}
+    for (vcs, old_vcs), sew_data in zip(circuits_vcs, sew_datas):
+        qasm_obs_exp_values = utils.expected_values(probs, vcs, old_vcs)
+        final_results.append(cut_strategy_module.sew(qasm_obs_exp_values, sew_data))
+        all_exp_values.update(qasm_obs_exp_values)
+    times = utils.record_time(times, TIME_SEW, start)
+
+    end_time = perf_counter()
+    times[TIME_TOTAL] = end_time - initial_time
+
+    record_ledger(input_flags, {
+        "operation": "cc_sw_batch",
+        "circuit": circuits,
+        "observable": observables,
+        "shots": shots,
+        "backends": provider_backend_couples,
+        "cut_strategy": cut_strategy_module.__name__,
+        "shots_allocation": shots_allocation_module.__name__,
+        "sw_policy": sw_policy_module.__name__,
+        "parallel_execution": parallel_execution_flag,
+    }, times, cut_infos, sum(len(dispatch[provider][backend]) for provider in dispatch for backend in dispatch[provider]), execution_info, final_results)
+
+    results = {}
+    if params_flag:
+        results["params"] = {
+            "circuits": circuits,
+            "observable": observables,
+            "shots": shots,
+            "backends": provider_backend_couples,
+            "cut_strategy": cut_strategy_module.__name__,
+            "shots_allocation": shots_allocation_module.__name__,
+            "shot_wise_policy": sw_policy_module.__name__,
+            "operation": "cc_sw_batch",
+            "metadata": metadata
+        }
+    results["results"] = final_results
+
+    if times_flag: 
+        results["times"]=  times
+    if stats_flag:
+        results["stats"] = {
+            "cut_info": cut_infos,
+            "requested_variations": requested_variations,
+            "executed_variations": len(pooled),
+            "dispatch": dispatch,
+            "counts": counts,
+            "execution_info": execution_info,
+            "resources": resources,
+            "probs": probs,
+            "split_coefficients": split_coefficients,
+            "merge_coefficients": merge_coefficients,
+            "exp_values": all_exp_values,
+        }
+
+    return results
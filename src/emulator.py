@@ -0,0 +1,158 @@
+'''
+This file implements the emulated provider of Cut&Shoot: backends that execute the circuits on a local Aer simulator behind the asynchronous job
+API of a cloud provider, so that the dispatch, the retries and the shot-wise policies can be benchmarked offline against QPU-like behaviour.
+Each emulated backend has a profile, given in the configuration file as emulated_backends and used by the backends ["emulated", name]:
+    simulator: the ibm_aer backend executing the circuits, e.g. "aer.fake_kyoto" (default "aer.perfect")
+    queue_latency: seconds a job waits in the queue, a number or a distribution [name, parameters...] among
+        ["constant", seconds], ["uniform", low, high], ["exponential", mean] and ["lognormal", median, sigma] (default 0)
+    job_overhead: seconds added to the execution of each job, e.g. the compilation and the loading of the job (default 0)
+    concurrency: maximum number of jobs of the backend queued or running at the same time, the others wait to be submitted (default 1)
+    failure_rate: probability that a job fails, its result is None as for a failed job of a provider (default 0)
+    seed: seed of the latencies and of the failures (default None)
+The concurrency limit and the random generator of each backend are kept in a registry of the process, so that they are shared by the
+dispatchers of the process (e.g. the retries of an execution or the runs of the service).
+'''
+import threading, math, random
+from time import perf_counter
+
+PROVIDER = "emulated"
+
+DEFAULT_PROFILE = {
+    "simulator": "aer.perfect",
+    "queue_latency": 0.0,
+    "job_overhead": 0.0,
+    "concurrency": 1,
+    "failure_rate": 0.0,
+    "seed": None,
+}
+
+#emulated backend name -> {"semaphore", "random", "lock"}
+_registry = {}
+_registry_lock = threading.Lock()
+
+def get_profile(profiles, backend):
+    if not profiles or backend not in profiles:
+        raise ValueError(f"Emulated backend {backend} has no profile, add it to emulated_backends")
+    profile = DEFAULT_PROFILE.copy()
+    profile.update(profiles[backend])
+    return profile
+
+def get_state(backend, profile):
+    #the first profile of a backend sizes its concurrency limit and seeds its generator
+    with _registry_lock:
+        if backend not in _registry:
+            _registry[backend] = {
+                "semaphore": threading.BoundedSemaphore(max(1, int(profile["concurrency"]))),
+                "random": random.Random(profile["seed"]),
+                "lock": threading.Lock(),
+            }
+        return _registry[backend]
+
+def sample_latency(spec, rng):
+    if isinstance(spec, (int, float)):
+        return float(spec)
+    name, *parameters = spec
+    if name == "constant":
+        return float(parameters[0])
+    if name == "uniform":
+        return rng.uniform(parameters[0], parameters[1])
+    if name == "exponential":
+        return rng.expovariate(1.0/parameters[0]) if parameters[0] > 0 else 0.0
+    if name == "lognormal":
+        return rng.lognormvariate(math.log(parameters[0]), parameters[1])
+    raise ValueError(f"Queue latency distribution {name} not supported")
+
+
+class EmulatedJob:
+    """Job submitted to an emulated backend.
+
+    The job is executed by a thread: it waits for a slot of the backend, stays in the queue for the sampled latency and is executed on the
+    simulator after the job overhead, unless it fails or is cancelled.
+
+    Parameters
+    ----------
+    backend : EmulatedBackend
+        The backend of the job.
+    circuit : QuantumCircuit
+        The circuit to execute.
+    shots : int
+        The number of shots.
+    options : dict
+        The run options of the simulator.
+    """
+
+    def __init__(self, backend, circuit, shots, options):
+        self.backend = backend
+        self.queue_time = 0.0
+        self._status = "QUEUED"
+        self._result = None
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._work, args=(circuit, shots, options), daemon=True)
+        self._thread.start()
+
+    def _work(self, circuit, shots, options):
+        profile = self.backend.profile
+        state = self.backend.state
+        #the queue time includes the wait for a slot of the backend
+        start = perf_counter()
+        try:
+            with state["semaphore"]:
+                with state["lock"]:
+                    latency = sample_latency(profile["queue_latency"], state["random"])
+                    failed = state["random"].random() < profile["failure_rate"]
+                if self._cancelled.wait(latency):
+                    self._status = "CANCELLED"
+                    return
+                self.queue_time = perf_counter() - start
+                self._status = "RUNNING"
+                if self._cancelled.wait(profile["job_overhead"]):
+                    self._status = "CANCELLED"
+                    return
+                if failed:
+                    self._status = "ERROR"
+                    return
+                self._result = self.backend.simulator.run(circuit, shots=shots, **options).result()
+                self._status = "DONE"
+        except Exception:  # pylint: disable=broad-except
+            self._status = "ERROR"
+        finally:
+            self._done.set()
+
+    def status(self):
+        return self._status
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancel(self):
+        #a queued job is removed from the queue, a running one is not interrupted
+        self._cancelled.set()
+
+    def result(self, timeout=None):
+        #None if the job failed or was cancelled, as for a failed job of a provider
+        self._done.wait(timeout)
+        return self._result
+
+
+class EmulatedBackend:
+    """Backend of the emulated provider, with the run interface of the qiskit backends.
+
+    Parameters
+    ----------
+    name : str
+        The name of the emulated backend.
+    profile : dict
+        The profile of the backend (see DEFAULT_PROFILE).
+    simulator : AerSimulator
+        The simulator executing the circuits.
+    """
+
+    def __init__(self, name, profile, simulator):
+        self.name = name
+        self.profile = profile
+        self.simulator = simulator
+        self.state = get_state(name, profile)
+
+    def run(self, circuit, shots, **options):
+        return EmulatedJob(self, circuit, shots, options)
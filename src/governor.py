@@ -0,0 +1,63 @@
+'''
+This file implements the CPU resource governor of Cut&Shoot. An execution has three nested layers of parallelism: the processes of the parallel
+execution (one per backend), the threads of each qukit.Dispatcher (one per backend of the process) and the OpenMP threads of each AerSimulator.
+Left alone, every layer sizes itself on the whole machine and the cores are oversubscribed. The governor splits the cores among the layers:
+    processes * dispatcher_workers * aer_threads <= cores
+Each layer can be fixed in the configuration file, the governor sizes the others on the remaining cores. In the parallel execution the
+processes are the backends executed at the same time, each one by its own process. The process pools of the stages before the execution
+(the cut of a batch and the preprocessing of the fragments) run alone and are limited to the cores of the run. Runs sharing the machine
+(e.g. the concurrent jobs of the service) are given a share of the cores each. The governor is disabled with governor = False.
+'''
+import os
+
+def available_cores():
+    try:
+        #cores the process is allowed to run on (e.g. in a container or with taskset)
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def share_cores(runs):
+    #cores of each of the runs executed at the same time
+    return max(1, available_cores() // max(1, runs))
+
+def pool_processes(processes=None, cores=None):
+    #processes of a pool running alone on the cores of the run, None for one per core
+    if cores is None:
+        cores = available_cores()
+    return cores if processes is None else max(1, min(processes, cores))
+
+def count_backends(dispatch):
+    return sum(len(dispatch[provider]) for provider in dispatch)
+
+def aer_options(aer_threads):
+    #one experiment per run (see qukit.run_circuits_on_backend), the threads go to the shots or to the statevector
+    return {
+        "max_parallel_threads": aer_threads,
+        "max_parallel_experiments": 1,
+        "max_parallel_shots": aer_threads,
+    }
+
+def allocate(dispatch, parallel_execution_flag, cores=None, processes=None, dispatcher_workers=None, aer_threads=None):
+    num_backends = max(count_backends(dispatch), 1)
+    if cores is None:
+        cores = available_cores()
+    if processes is None:
+        processes = min(num_backends, cores) if parallel_execution_flag else 1
+    processes = max(1, min(processes, num_backends)) if parallel_execution_flag else 1
+    process_cores = max(1, cores // processes)
+    #backends executed by each process, each one in a thread of the dispatcher: the parallel execution runs a process per backend,
+    #at most processes at the same time
+    process_backends = 1 if parallel_execution_flag else num_backends
+    if dispatcher_workers is None:
+        dispatcher_workers = min(process_backends, process_cores)
+    dispatcher_workers = max(1, min(dispatcher_workers, process_backends))
+    if aer_threads is None:
+        aer_threads = max(1, process_cores // dispatcher_workers)
+    return {
+        "cores": cores,
+        "processes": processes,
+        "dispatcher_workers": dispatcher_workers,
+        "aer_threads": aer_threads,
+        "aer_options": aer_options(aer_threads),
+    }
@@ -0,0 +1,185 @@
+'''
+This file implements the run ledger of Cut&Shoot: a local SQLite database where each run appends its parameters, its stage times, the time of
+each job executed on the backends, the size of its cut and its result, so that the performance of the tool can be followed across runs.
+The ledger is written by cutnshot.cutnshot and cutnshot.cutnshot_batch when input_flags["ledger"] is the path of the database, it is queried with
+    python main.py ledger [--db DB] [--stage STAGE] [--calibrate CALIBRATION]
+which reports the percentiles of a stage time per policy and of the execution time of each backend per policy, and fits the planner time model
+(see planner.py) on the job times.
+
+Tables:
+    runs(run_id, timestamp, operation, circuit_hash, observable, shots, backends, cut_strategy, shots_allocation, sw_policy, parallel_execution,
+        num_fragments, num_cuts, num_variations, num_jobs, result, error)
+    stage_times(run_id, stage, seconds)
+    backend_jobs(run_id, provider, backend, circuit_name, observable, shots, qubits, num_gates, seconds)
+Lists and results are stored as JSON.
+'''
+import sqlite3, json, datetime
+from utils import hash_circuit
+
+# numpy is imported by the queries, the ledger is imported by the pipeline at start-up (see benchmarks/startup.py)
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT,
+        operation TEXT,
+        circuit_hash TEXT,
+        observable TEXT,
+        shots INTEGER,
+        backends TEXT,
+        cut_strategy TEXT,
+        shots_allocation TEXT,
+        sw_policy TEXT,
+        parallel_execution INTEGER,
+        num_fragments INTEGER,
+        num_cuts INTEGER,
+        num_variations INTEGER,
+        num_jobs INTEGER,
+        result TEXT,
+        error TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS stage_times (
+        run_id INTEGER REFERENCES runs(run_id),
+        stage TEXT,
+        seconds REAL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS backend_jobs (
+        run_id INTEGER REFERENCES runs(run_id),
+        provider TEXT,
+        backend TEXT,
+        circuit_name TEXT,
+        observable TEXT,
+        shots INTEGER,
+        qubits INTEGER,
+        num_gates INTEGER,
+        seconds REAL
+    )''',
+    "CREATE INDEX IF NOT EXISTS stage_times_run ON stage_times(run_id, stage)",
+    "CREATE INDEX IF NOT EXISTS backend_jobs_run ON backend_jobs(run_id)",
+]
+
+def connect(path):
+    #the timeout lets concurrent runs (e.g. the service workers) wait for each other's writes
+    conn = sqlite3.connect(path, timeout=30)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+def cut_size(cut_info, key):
+    #cut_info is a list in the batch runs
+    if isinstance(cut_info, list):
+        values = [info.get(key) for info in cut_info if info]
+        return sum(values) if values and None not in values else None
+    return cut_info.get(key) if cut_info else None
+
+def record_run(path, params, times, cut_info, num_jobs, execution_info, result, error=None):
+    #params: circuit (or list of circuits), observable, shots, backends, cut_strategy, shots_allocation, sw_policy, parallel_execution, operation
+    circuits = params["circuit"] if isinstance(params["circuit"], list) else [params["circuit"]]
+    jobs = []
+    for provider in execution_info:
+        for backend in execution_info[provider]:
+            for circuit_name, observable, info in execution_info[provider][backend]:
+                jobs.append((provider, backend, circuit_name, observable, info.get("shots"), info.get("qubits"), info.get("num_gates"), info.get("time")))
+    conn = connect(path)
+    try:
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO runs (timestamp, operation, circuit_hash, observable, shots, backends, cut_strategy, shots_allocation, sw_policy, parallel_execution, "
+                "num_fragments, num_cuts, num_variations, num_jobs, result, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    params["operation"],
+                    ",".join(hash_circuit(c) for c in circuits),
+                    json.dumps(params["observable"]),
+                    params["shots"],
+                    json.dumps(params["backends"]),
+                    params["cut_strategy"],
+                    params["shots_allocation"],
+                    params["sw_policy"],
+                    int(bool(params["parallel_execution"])),
+                    cut_size(cut_info, "num_fragments"),
+                    cut_size(cut_info, "num_cuts"),
+                    cut_size(cut_info, "num_variations"),
+                    num_jobs,
+                    #results can be numpy scalars
+                    json.dumps(result, default=float),
+                    json.dumps(error, default=float) if error is not None else None,
+                )
+            )
+            run_id = cursor.lastrowid
+            conn.executemany("INSERT INTO stage_times (run_id, stage, seconds) VALUES (?, ?, ?)", [(run_id, stage, seconds) for stage, seconds in times.items()])
+            conn.executemany(
+                "INSERT INTO backend_jobs (run_id, provider, backend, circuit_name, observable, shots, qubits, num_gates, seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id,)+job for job in jobs]
+            )
+    finally:
+        conn.close()
+    return run_id
+
+def percentiles(values):
+    import numpy as np
+    values = sorted(values)
+    return {
+        "runs": len(values),
+        "mean": sum(values)/len(values),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+    }
+
+def summary(path, stage="time_execution"):
+    import numpy as np
+    conn = connect(path)
+    try:
+        by_policy = {}
+        for policy, seconds in conn.execute(
+            "SELECT r.sw_policy, s.seconds FROM stage_times s JOIN runs r ON r.run_id = s.run_id WHERE s.stage = ?", (stage,)
+        ):
+            by_policy.setdefault(policy, []).append(seconds)
+        #time spent by each backend in a run: its jobs are executed one after the other
+        by_backend = {}
+        for backend, policy, seconds, shots in conn.execute(
+            "SELECT j.provider || '/' || j.backend, r.sw_policy, SUM(j.seconds), SUM(j.shots) FROM backend_jobs j JOIN runs r ON r.run_id = j.run_id "
+            "WHERE j.seconds IS NOT NULL GROUP BY j.run_id, j.provider, j.backend"
+        ):
+            by_backend.setdefault(backend, {}).setdefault(policy, []).append((seconds, shots))
+        num_runs = conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+    finally:
+        conn.close()
+
+    backends = {}
+    for backend in by_backend:
+        backends[backend] = {}
+        for policy, samples in by_backend[backend].items():
+            backends[backend][policy] = percentiles([seconds for seconds, _ in samples])
+            backends[backend][policy]["shots_per_second_p50"] = float(np.percentile([shots/seconds for seconds, shots in samples if seconds > 0] or [0.0], 50))
+    return {
+        "runs": num_runs,
+        "stage": stage,
+        "by_policy": {policy: percentiles(values) for policy, values in by_policy.items()},
+        "backend_time_by_policy": backends,
+    }
+
+def calibration(path, min_jobs=3):
+    #fits on the job times the planner model: job_time = job_overhead + shots * (shot_time + gate_time * num_gates * 2**qubits)
+    import numpy as np
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            "SELECT provider || '/' || backend, shots, qubits, num_gates, seconds FROM backend_jobs "
+            "WHERE seconds IS NOT NULL AND shots IS NOT NULL AND qubits IS NOT NULL AND num_gates IS NOT NULL"
+        ).fetchall()
+    finally:
+        conn.close()
+    jobs = {}
+    for backend, shots, qubits, num_gates, seconds in rows:
+        jobs.setdefault(backend, []).append((shots, qubits, num_gates, seconds))
+    models = {}
+    for backend, samples in jobs.items():
+        if len(samples) < min_jobs:
+            continue
+        a = np.array([[1.0, shots, shots * num_gates * 2**qubits] for shots, qubits, num_gates, _ in samples])
+        b = np.array([seconds for _, _, _, seconds in samples])
+        coefficients, _, _, _ = np.linalg.lstsq(a, b, rcond=None)
+        job_overhead, shot_time, gate_time = (max(float(c), 0.0) for c in coefficients)
+        models[backend] = {"job_overhead": job_overhead, "shot_time": shot_time, "gate_time": gate_time, "jobs": len(samples)}
+    return models
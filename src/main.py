@@ -1,6 +1,7 @@
 
 import logging, cutnshot, json, configparser, importlib, os
-from utils import hash_circuit
+from utils import stats_to_json, is_single_observable
+from qukit import check_shot_chunk_size
 from argparse import ArgumentParser
 from os.path import join, dirname
 from dotenv import load_dotenv
@@ -23,9 +24,41 @@ def main():
     parser.add_argument('--stats', '-s', help='Intermediate stats of the pipeline run. Printed in out.json without -o. Includes -t.', action='store_true')
     parser.add_argument('--output', '-o', help='Specify the file name where print all the stats. Includes -p and -s.', default=None)
     parser.add_argument('--verbose', '-v', help='Verbose mode for the output.', action='store_true')
+    parser.add_argument('--plan', help='Dry run: cut, allocate and split the shots, and print the estimated cost of the run without executing it.', action='store_true')
+    parser.add_argument('--serve', help='Run Cut&Shoot as a service, accepting jobs through a local HTTP API.', action='store_true')
+    parser.add_argument('--host', type=str, help='Host address of the service.', default="127.0.0.1")
+    parser.add_argument('--port', type=int, help='Port of the service.', default=8080)
+    parser.add_argument('--workers', type=int, help='Number of jobs run concurrently by the service.', default=2)
+    subparsers = parser.add_subparsers(dest="command")
+    ledger_parser = subparsers.add_parser('ledger', help='Query the ledger of the runs.')
+    ledger_parser.add_argument('--db', type=str, help='Ledger database, the ledger of the configuration file if not given.', default=None)
+    ledger_parser.add_argument('--stage', type=str, help='Stage time to aggregate.', default="time_execution")
+    ledger_parser.add_argument('--calibrate', type=str, help='JSON file where to write the planner calibration fitted on the job times.', default=None)
     
     args = parser.parse_args()
 
+    if args.command == "ledger":
+        import ledger
+        db = args.db
+        if db is None:
+            config = configparser.ConfigParser()
+            config.read(args.configfile)
+            db = os.path.join(os.path.dirname(__file__), json.loads(config["SETTINGS"]["ledger"]) if "ledger" in config["SETTINGS"] else "ledger.db")
+        report = ledger.summary(db, args.stage)
+        if args.calibrate:
+            report["calibration"] = ledger.calibration(db)
+            with open(args.calibrate, "w") as f:
+                json.dump(report["calibration"], f, indent=4)
+        print(json.dumps(report, indent=4))
+        return
+
+    if args.serve:
+        import service
+        if args.verbose:
+            logger.setLevel(logging.DEBUG)
+        service.serve(args.host, args.port, args.workers)
+        return
+
     input_flags = {}
     times_flag = args.times
     params_flag = args.params
@@ -55,16 +88,66 @@ def main():
     shots = int(json.loads(config["SETTINGS"]["shots"]))
     observable_string = json.loads(config["SETTINGS"]["observables"])
     input_flags["parallel_execution_flag"] = False if not config["SETTINGS"]["parallel_execution"] or config["SETTINGS"]["parallel_execution"] != "True" else True
+    if "agents" in config["SETTINGS"]:
+        input_flags["agents"] = json.loads(config["SETTINGS"]["agents"])
+    if "agent_timeout" in config["SETTINGS"]:
+        input_flags["agent_timeout"] = float(json.loads(config["SETTINGS"]["agent_timeout"]))
+    if "agent_job_timeout" in config["SETTINGS"]:
+        input_flags["agent_job_timeout"] = float(json.loads(config["SETTINGS"]["agent_job_timeout"]))
+    if "shot_chunk_size" in config["SETTINGS"]:
+        input_flags["shot_chunk_size"] = check_shot_chunk_size(int(json.loads(config["SETTINGS"]["shot_chunk_size"])))
+    #shares of the cores given to the layers of the execution, the missing ones are sized by the resource governor (see governor.py)
+    input_flags["resources"] = {key: int(json.loads(config["SETTINGS"][key])) for key in ["cores", "processes", "dispatcher_workers", "aer_threads"] if key in config["SETTINGS"]}
+    input_flags["governor"] = not ("governor" in config["SETTINGS"] and config["SETTINGS"]["governor"] == "False")
+    if "emulated_backends" in config["SETTINGS"]:
+        input_flags["emulated_backends"] = json.loads(config["SETTINGS"]["emulated_backends"])
+    input_flags["speculative_flag"] = "speculative_execution" in config["SETTINGS"] and config["SETTINGS"]["speculative_execution"] == "True"
+    if input_flags["speculative_flag"] and input_flags.get("agents"):
+        #the agents reassign the jobs of a lost agent, they do not duplicate the stragglers
+        raise ValueError("speculative_execution is not supported with agents")
+    if "straggler_factor" in config["SETTINGS"]:
+        input_flags["straggler_factor"] = float(json.loads(config["SETTINGS"]["straggler_factor"]))
+    input_flags["auto_simulation_method"] = "auto_simulation_method" in config["SETTINGS"] and config["SETTINGS"]["auto_simulation_method"] == "True"
+
+    if "preprocessing_processes" in config["SETTINGS"]:
+        input_flags["preprocessing_processes"] = int(json.loads(config["SETTINGS"]["preprocessing_processes"]))
+    input_flags["deferred_qasm_flag"] = "deferred_qasm_export" in config["SETTINGS"] and config["SETTINGS"]["deferred_qasm_export"] == "True"
+    input_flags["sampling_flag"] = "sampled_sewing" in config["SETTINGS"] and config["SETTINGS"]["sampled_sewing"] == "True"
+    if "sampling_seed" in config["SETTINGS"]:
+        input_flags["sampling_seed"] = int(json.loads(config["SETTINGS"]["sampling_seed"]))
+    input_flags["low_memory_flag"] = "low_memory" in config["SETTINGS"] and config["SETTINGS"]["low_memory"] == "True"
+    if input_flags["low_memory_flag"] and stats_flag:
+        #the stats are written next to the output while the pipeline runs
+        input_flags["stats_file"] = os.path.splitext(os.path.join(os.path.dirname(__file__), output_file) if output_file else "out.json")[0]+"_stats.jsonl"
+    if "ledger" in config["SETTINGS"]:
+        input_flags["ledger"] = os.path.join(os.path.dirname(__file__), json.loads(config["SETTINGS"]["ledger"]))
+    if "plan_calibration" in config["SETTINGS"]:
+        input_flags["plan_calibration"] = os.path.join(os.path.dirname(__file__), json.loads(config["SETTINGS"]["plan_calibration"]))
+    if "perf_exp_val" in config["SETTINGS"]:
+        input_flags["perf_exp_val"] = float(json.loads(config["SETTINGS"]["perf_exp_val"]))
 
     circuit_file = json.loads(config["SETTINGS"]["circuit"])
-    path = os.path.join(os.path.dirname(__file__), circuit_file)
-    with open(path, "r") as f:
-        circuit_qasm = f.read()
+    #a list of circuit files is run as a batch, sharing a single dispatch
+    batch = isinstance(circuit_file, list)
+    circuits_qasm = []
+    for file in (circuit_file if batch else [circuit_file]):
+        path = os.path.join(os.path.dirname(__file__), file)
+        with open(path, "r") as f:
+            circuits_qasm.append(f.read())
 
     provider_backend_couples = json.loads(config["SETTINGS"]["backends"])
 
     cut_strategy = json.loads(config["SETTINGS"]["cut_strategy_module"])
     cut_strategy_module = importlib.import_module(cut_strategy)
+    if "cut_cost_module" in config["SETTINGS"] and hasattr(cut_strategy_module, "cost_module"):
+        #cost model of the cutting tools that search the cut (e.g. pennylane_search_tool)
+        cut_strategy_module.cost_module = importlib.import_module(json.loads(config["SETTINGS"]["cut_cost_module"]))
+    for flag, option, function in [("deferred_qasm_flag", "deferred_qasm_export", "cut_deferred"), ("sampling_flag", "sampled_sewing", "cut_sampled")]:
+        if input_flags[flag] and not hasattr(cut_strategy_module, function):
+            raise ValueError(f"{option} is not supported by the cutting tool {cut_strategy}")
+    if hasattr(cut_strategy_module, "processes"):
+        #the search of the cut runs before the execution, its pool is limited by the governor to the cores of the run
+        cut_strategy_module.processes = cutnshot.get_pool_processes(input_flags, cut_strategy_module.processes)
     
 
     shotwise_policy = json.loads(config["SETTINGS"]["sw_policy_module"])
@@ -73,8 +156,26 @@ def main():
     shots_allocation_name = json.loads(config["SETTINGS"]["shots_allocation_module"])
     shots_allocation_module = importlib.import_module(shots_allocation_name)
 
-    result = cutnshot.cutnshot(
-        circuit_qasm,
+    if args.plan:
+        import planner
+        calibration = None
+        if "plan_calibration" in input_flags:
+            calibration = planner.load_calibration(input_flags["plan_calibration"])
+        plans = []
+        #in a batch the observables can be one per circuit, as in cutnshot.cutnshot_batch
+        observables = [observable_string]*len(circuits_qasm) if not batch or is_single_observable(observable_string) else observable_string
+        for circuit_qasm, observable in zip(circuits_qasm, observables):
+            plans.append(planner.plan(circuit_qasm, observable, shots, provider_backend_couples, cut_strategy_module, shots_allocation_module, sw_policy_module, calibration))
+        report = plans if batch else plans[0]
+        logger.info(f"Plan: {json.dumps(report, indent=4)}")
+        if output_file:
+            with open(os.path.join(os.path.dirname(__file__), output_file), "w") as f:
+                json.dump(report, f)
+        return
+
+    pipeline = cutnshot.cutnshot_batch if batch else cutnshot.cutnshot
+    result = pipeline(
+        circuits_qasm if batch else circuits_qasm[0],
         observable_string,
         shots,
         provider_backend_couples,
@@ -91,7 +192,10 @@ def main():
 
     if "perf_exp_val" in config["SETTINGS"]:
         perf_exp_val = float(json.loads(config["SETTINGS"]["perf_exp_val"]))
-        error = perf_exp_val-result["results"]
+        if batch:
+            error = [perf_exp_val-r for r in result["results"]]
+        else:
+            error = perf_exp_val-result["results"]
         if params_flag:
             result["params"]["perf_exp_val"] = perf_exp_val
         result["error"] = error
@@ -99,30 +203,7 @@ def main():
         logger.info(f"Error: {error}")
 
     if output_file or stats_flag:
-        dispatch = result["stats"]["dispatch"]
-        new_dispatch = {} #make it json serializable
-        for provider in dispatch:
-            for backend in dispatch[provider]:
-                if provider not in new_dispatch:
-                    new_dispatch[provider] = {}
-                if backend not in new_dispatch[provider]:
-                    new_dispatch[provider][backend] = []
-                for frag, shots in dispatch[provider][backend]:
-                    new_dispatch[provider][backend].append((frag.circuit, shots))
-        result["stats"]["dispatch"] = new_dispatch
-
-        probs = result["stats"]["probs"]
-        new_probs = {}
-        for k in probs:
-            new_probs[str(k)] = probs[k]
-        result["stats"]["probs"] = new_probs
-
-        qasm_obs_exp_values = result["stats"]["exp_values"]
-        exp_vals = {}
-        for qasm, obs in qasm_obs_exp_values:
-            hash = hash_circuit(qasm)
-            exp_vals[str((hash,obs))] = qasm_obs_exp_values[(qasm, obs)]
-        result["stats"]["exp_values"] = exp_vals
+        result["stats"] = stats_to_json(result["stats"])
 
     if output_file:
         with open(os.path.join(os.path.dirname(__file__), output_file), "w") as f:
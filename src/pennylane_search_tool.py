@@ -0,0 +1,92 @@
+'''
+This file implements a cutting tool that searches the cut to apply, based on pennylane_tool.
+Candidate cut configurations (number of fragments and maximum fragment width) are evaluated in parallel, each one is scored by a cost model and
+the cheapest is executed. The cutting tool implements the same interface of pennylane_tool:
+    - cut: cut(circuit, observable_string) -> output, cut_data, cut_info
+    - sew: sew(qasm_obs_expvals, sew_data)  -> results
+The cost model is a Python script (e.g. policies/cut_cost_variations.py) implementing cost(candidate) -> cost, it can be changed by setting cost_module
+(main.py sets it from cut_cost_module in the configuration file). processes is the number of processes used for the search (None uses all the cores), main.py and the service limit it to the cores given to the run by the
+resource governor.
+'''
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+from pennylane import qml
+from utils import observable_terms
+from pennylane_tool import sew, qasm_to_pennylane, tapes_to_qasm, fragment_cut_ops, cut_pauli_sum, get_cut_params
+
+DEFAULT_COST_MODULE = "policies.cut_cost_variations"
+cost_module = None
+processes = None
+
+def get_candidates(circuit):
+    circuit_qubits = circuit.num_wires
+    #the default cut of pennylane_tool is always a candidate
+    candidates = [get_cut_params(circuit)]
+    for num_fragments in range(2, circuit_qubits//2+2):
+        for max_free_wires in range(2, circuit_qubits):
+            if max_free_wires*num_fragments < circuit_qubits:
+                continue
+            candidates.append({"max_free_wires": max_free_wires, "min_free_wires": 2, "num_fragments_probed": num_fragments})
+    return candidates
+
+def evaluate_candidate(ops, observables, cut_params):
+    try:
+        uncut_tape = qml.tape.QuantumTape(ops, [qml.expval(qml.pauli.string_to_pauli_word(observables))])
+        cut_graph = qml.qcut.find_and_place_cuts(
+            graph = qml.qcut.tape_to_graph(uncut_tape),
+            cut_strategy = qml.qcut.CutStrategy(**cut_params),
+        )
+        cut_ops = qml.qcut.graph_to_tape(cut_graph).operations
+        _, _, _, _, cut_info = fragment_cut_ops(cut_ops, observables)
+    except Exception:  # pylint: disable=broad-except
+        #no valid cut for these parameters
+        return None
+    candidate = {k: cut_info[k] for k in ["num_fragments", "num_cuts", "fragments_qubits", "variations", "fragments_2q_gates"]}
+    return cut_ops, candidate
+
+def search_cut(ops, observables, candidates):
+    module = cost_module if cost_module is not None else importlib.import_module(DEFAULT_COST_MODULE)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        evaluations = list(executor.map(evaluate_candidate, [ops]*len(candidates), [observables]*len(candidates), candidates))
+
+    best = None
+    search_info = []
+    for cut_params, evaluation in zip(candidates, evaluations):
+        if evaluation is None:
+            continue
+        cut_ops, candidate = evaluation
+        candidate_cost = module.cost(candidate)
+        search_info.append({"cut_params": cut_params, "cost": candidate_cost, "num_cuts": candidate["num_cuts"], "fragments_qubits": candidate["fragments_qubits"]})
+        #fewer cuts on ties
+        if best is None or (candidate_cost, candidate["num_cuts"]) < (best[0], best[1]):
+            best = (candidate_cost, candidate["num_cuts"], cut_params, cut_ops)
+    if best is None:
+        raise ValueError("No valid cut found for the circuit")
+    return best, search_info
+
+def cut(circuit, observable_string):
+    terms = observable_terms(observable_string)
+    measured_terms = [pauli for _, pauli in terms if set(pauli) != {"I"}]
+    if not measured_terms:
+        raise ValueError("The observable has no term to measure")
+
+    penny_circ = qasm_to_pennylane(circuit)
+    qs = qml.tape.make_qscript(penny_circ)()
+    candidates = get_candidates(qs)
+    (best_cost, _, best_params, cut_ops), search_info = search_cut(qs.operations, measured_terms[0], candidates)
+
+    if isinstance(observable_string, str):
+        tapes, communication_graph, prepare_nodes, measure_nodes, cut_info = fragment_cut_ops(cut_ops, observable_string)
+        output, tapes_info = tapes_to_qasm(tapes)
+        sew_data = {"tapes_info": tapes_info,"communication_graph": communication_graph, "prepare_nodes": prepare_nodes, "measure_nodes": measure_nodes}
+    else:
+        output, sew_data, cut_info = cut_pauli_sum(circuit, terms, cut_ops=cut_ops)
+
+    cut_info["cut_search"] = {
+        "cost_module": (cost_module.__name__ if cost_module is not None else DEFAULT_COST_MODULE),
+        "num_candidates": len(candidates),
+        "chosen_params": best_params,
+        "chosen_cost": best_cost,
+        "candidates": search_info,
+    }
+    return output, sew_data, cut_info
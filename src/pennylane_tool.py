@@ -3,7 +3,7 @@ This file implements the function of the cutting tool.
 The cutting tool must implement the following functions:
     - cut: cut(circuit, observable_string) -> output, cut_data, cut_info
         circuit: QASM circuit to cut
-        observable_string: observable to measure on the circuit
+        observable_string: observable to measure on the circuit, a Pauli string or a weighted sum of Pauli strings (see utils.observable_terms)
         output: list of tuples (fragment, observable) where fragment is a QASM circuit without basis changes and observable is a list of string representing the observables
         cut_data: dictionary containing data needed by the sew function
         cut_info: dictionary containing information about the cut recorded by the experiments (can be None)
@@ -11,20 +11,152 @@ The cutting tool must implement the following functions:
         qasm_obs_expvals: dictionary (fragment, observable) -> expected value, where (fragment , observable) are the tuples returned by the cut function and expected value is the expected value of the fragment execution
         sew_data: dictionary containing data needed by the sew function
         results: results of the sew function
+The cutting tool can also implement the version of cut with deferred QASM export, used when the pipeline runs with deferred_qasm_export
+(see cutnshot.prepare_deferred_fragments):
+    - cut_deferred: cut_deferred(circuit, observable_string) -> variations, cut_data, cut_info
+        variations: iterable of tuples (key, qasm_fun, observable, stats), one for each fragment variation, where qasm_fun() returns the QASM of the variation
+            with the measurement of the observable and stats are the stats of the variation (as qukit.VirtualCircuit.describe); the sew receives the
+            expected values keyed by (key, observable). The QASM of the variations is exported by a single thread (see qukit.export_executor)
 '''
 
 from pennylane import qml
 from typing import Any, Optional, Callable
-import hashlib
+from utils import observable_terms, push_obs
+from qukit import VirtualCircuit
+import hashlib, collections
 
 def cut(circuit, observable_string):
+    if not isinstance(observable_string, str):
+        return cut_pauli_sum(circuit, observable_terms(observable_string))
     tapes, communication_graph, prepare_nodes, measure_nodes, cut_info = pennylane_cut(circuit, observable_string)    
     #output, tapes_info = tapes_to_vc(tapes_len)
     output, tapes_info = tapes_to_qasm(tapes)
     sew_data = {"tapes_info": tapes_info,"communication_graph": communication_graph, "prepare_nodes": prepare_nodes, "measure_nodes": measure_nodes}
     return output, sew_data, cut_info
 
+def cut_deferred(circuit, observable_string):
+    if not isinstance(observable_string, str):
+        #the terms of a Pauli sum share their variations, their QASM is exported by cut and only their stats are given to the allocation
+        output, sew_data, cut_info = cut(circuit, observable_string)
+        return eager_variations(output), sew_data, cut_info
+    tapes, communication_graph, prepare_nodes, measure_nodes, cut_info = pennylane_cut(circuit, observable_string)
+    tapes_info = []
+    sew_data = {"tapes_info": tapes_info,"communication_graph": communication_graph, "prepare_nodes": prepare_nodes, "measure_nodes": measure_nodes}
+    return deferred_variations(tapes, hash_circuit(circuit), tapes_info), sew_data, cut_info
+
+def deferred_variations(tapes, circuit_hash, tapes_info):
+    #tapes_info of the sew data is filled while the variations are generated, with the keys of the variations in place of their QASM
+    for t, tape in enumerate(tapes):
+        key = f"{circuit_hash}-{t}"
+        stats = tape_stats(tape)
+        tape_qasm = deferred_qasm(tape)
+        frag_list = []
+        for expval in tape.measurements:
+            obs = qml.pauli.pauli_word_to_string(expval.obs)
+            frag_list.append((key, obs))
+            yield key, variation_qasm_fun(tape_qasm, obs), obs, stats
+        tapes_info.append(frag_list)
+
+def eager_variations(output):
+    for qasm, observables in output:
+        stats = VirtualCircuit(qasm).describe()
+        for obs in observables:
+            yield qasm, variation_qasm_fun(lambda qasm=qasm: qasm, obs), obs, stats
+
+def deferred_qasm(tape):
+    #the QASM of a tape is exported once for all its observables
+    qasm = []
+    def fun():
+        if not qasm:
+            qasm.append(pennylane_to_qasm(tape))
+        return qasm[0]
+    return fun
+
+def variation_qasm_fun(qasm_fun, obs):
+    def fun():
+        return push_obs(VirtualCircuit(qasm_fun(), {"observable": obs, "qubits": len(obs)})).circuit
+    return fun
+
+def tape_stats(tape):
+    #stats of the variation computed on the tape, as qukit.circuit_stats: the basis changes and the measurements are added by push_obs
+    layers = collections.defaultdict(int)
+    layers_2q = collections.defaultdict(int)
+    depth = 0
+    depth_2q = 0
+    for op in tape.operations:
+        layer = max(layers[w] for w in op.wires)+1
+        for w in op.wires:
+            layers[w] = layer
+        depth = max(depth, layer)
+        if len(op.wires) == 2:
+            layer_2q = max(layers_2q[w] for w in op.wires)+1
+            for w in op.wires:
+                layers_2q[w] = layer_2q
+            depth_2q = max(depth_2q, layer_2q)
+    return {
+        "qubits": len(tape.wires),
+        "depth": depth,
+        "num_gates": len(tape.operations),
+        "2q_depth": depth_2q,
+        "num_1q_gates": sum(1 for op in tape.operations if len(op.wires) == 1),
+        "num_2q_gates": sum(1 for op in tape.operations if len(op.wires) == 2),
+        "num_measurements": len(tape.wires),
+        "gates": dict(collections.Counter(op.name for op in tape.operations)),
+    }
+
+def cut_pauli_sum(circuit, terms, cut_ops=None):
+    #identity terms do not need any execution
+    constant = sum(coeff for coeff, pauli in terms if set(pauli) == {"I"})
+    terms = [(coeff, pauli) for coeff, pauli in terms if set(pauli) != {"I"}]
+    if not terms:
+        raise ValueError("The observable has no term to measure")
+
+    if cut_ops is None:
+        penny_circ = qasm_to_pennylane(circuit)
+        qs = qml.tape.make_qscript(penny_circ)()
+        #the cuts are placed once, using the first term, and the same cut circuit is fragmented for every term
+        cut_ops = qml.qcut.graph_to_tape(find_cuts(qs.operations, terms[0][1])).operations
+
+    output = []
+    output_index = {}
+    terms_sew_data = []
+    terms_info = []
+    for coeff, pauli in terms:
+        tapes, communication_graph, prepare_nodes, measure_nodes, term_info = fragment_cut_ops(cut_ops, pauli)
+        term_output, tapes_info = tapes_to_qasm(tapes)
+        #fragment variations with the same circuit and measurement are shared between the terms
+        for qasm, observables in term_output:
+            if qasm not in output_index:
+                output_index[qasm] = len(output)
+                output.append((qasm, []))
+            fragment_observables = output[output_index[qasm]][1]
+            for obs in observables:
+                if obs not in fragment_observables:
+                    fragment_observables.append(obs)
+        terms_sew_data.append((coeff, {"tapes_info": tapes_info,"communication_graph": communication_graph, "prepare_nodes": prepare_nodes, "measure_nodes": measure_nodes}))
+        term_info["observable"] = pauli
+        term_info["coefficient"] = coeff
+        terms_info.append(term_info)
+
+    cut_info = {
+        "num_fragments": terms_info[0]["num_fragments"],
+        "fragments_qubits": terms_info[0]["fragments_qubits"],
+        "num_variations": sum(len(observables) for _, observables in output),
+        "num_variations_unshared": sum(info["num_variations"] for info in terms_info),
+        "num_terms": len(terms),
+        "terms": terms_info,
+    }
+    sew_data = {"constant": constant, "terms": terms_sew_data}
+    return output, sew_data, cut_info
+
 def sew(qasm_obs_expvals, sew_data):
+    if "terms" in sew_data:
+        #weighted sum of the terms of a Pauli-sum observable
+        result = sew_data["constant"]
+        for coeff, term_sew_data in sew_data["terms"]:
+            result = result + coeff * sew(qasm_obs_expvals, term_sew_data)
+        return result
+
     tapes_info = sew_data["tapes_info"]
     communication_graph = sew_data["communication_graph"]
     prepare_nodes = sew_data["prepare_nodes"]
@@ -103,17 +235,12 @@ def tapes_to_qasm(tapes):
         qasm_fragments.append((qasm, observables))
     return qasm_fragments, tapes_info
 
-def pennylane_cut(circuit, observables):
-    cut_info = {}
+def find_cuts(ops, observables):
     obs =  [qml.expval(qml.pauli.string_to_pauli_word(observables))]
-    penny_circ = qasm_to_pennylane(circuit)
-    qs = qml.tape.make_qscript(penny_circ)()
-    ops= qs.operations
-    
-    cut_params = get_cut_params(qs)
-
     uncut_tape = qml.tape.QuantumTape(ops, obs)
 
+    cut_params = get_cut_params(uncut_tape)
+
     #Se ci sono i num_fragments, si usano, altrimenti si usa la strategia
     graph = qml.qcut.tape_to_graph(uncut_tape)
     if 'num_fragments' in cut_params:
@@ -123,17 +250,21 @@ def pennylane_cut(circuit, observables):
         )
     else:
         cut_graph = qml.qcut.find_and_place_cuts(
-            graph = qml.qcut.tape_to_graph(uncut_tape),
+            graph = graph,
             cut_strategy = qml.qcut.CutStrategy(**cut_params),
         )
+    return cut_graph
 
-    qml.qcut.replace_wire_cut_nodes(cut_graph)
+def fragment_cut_graph(cut_graph):
+    cut_info = {}
     fragments, communication_graph = qml.qcut.fragment_graph(cut_graph)
     fragment_tapes = [qml.qcut.graph_to_tape(f) for f in fragments]
 
     cut_info["num_fragments"] = len(fragment_tapes)
 
     cut_info["fragments_qubits"] = [len(tape.wires) for tape in fragment_tapes]
+    cut_info["num_cuts"] = communication_graph.number_of_edges()
+    cut_info["fragments_2q_gates"] = [sum(1 for op in tape.operations if len(op.wires) == 2) for tape in fragment_tapes]
     # Creation of fragments varations
     expanded = [qml.qcut.expand_fragment_tape(t) for t in fragment_tapes]
     
@@ -158,4 +289,18 @@ def pennylane_cut(circuit, observables):
     cut_info["num_variations"] = num_variations
     cut_info["variations"] = variatons
 
-    return tapes, communication_graph, prepare_nodes, measure_nodes, cut_info
\ No newline at end of file
+    return tapes, communication_graph, prepare_nodes, measure_nodes, cut_info
+
+def fragment_cut_ops(cut_ops, observables):
+    #cut_ops: operations of the circuit with the qml.WireCut already placed
+    cut_tape = qml.tape.QuantumTape(cut_ops, [qml.expval(qml.pauli.string_to_pauli_word(observables))])
+    cut_graph = qml.qcut.tape_to_graph(cut_tape)
+    qml.qcut.replace_wire_cut_nodes(cut_graph)
+    return fragment_cut_graph(cut_graph)
+
+def pennylane_cut(circuit, observables):
+    penny_circ = qasm_to_pennylane(circuit)
+    qs = qml.tape.make_qscript(penny_circ)()
+    cut_graph = find_cuts(qs.operations, observables)
+    qml.qcut.replace_wire_cut_nodes(cut_graph)
+    return fragment_cut_graph(cut_graph)
\ No newline at end of file
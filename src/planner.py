@@ -0,0 +1,125 @@
+'''
+This file implements the dry-run planner of Cut&Shoot: it runs the cut, the shots allocation and the split of the pipeline, without executing anything
+on the backends, and estimates the cost of the run.
+The execution time of a job (a fragment variation with its shots on a backend) is predicted with a per-backend model:
+    job_time = job_overhead + shots * (shot_time + gate_time * num_gates * 2**qubits)
+The coefficients of the model are given by a calibration dictionary {backend: {"job_overhead": s, "shot_time": s, "gate_time": s}}, backends without
+calibration use DEFAULT_MODEL.
+'''
+import json
+from time import perf_counter
+import utils as utils
+from cutnshot import prepare_fragments
+
+DEFAULT_MODEL = {"job_overhead": 0.05, "shot_time": 1e-5, "gate_time": 1e-8}
+
+#rough sizes in bytes of the python objects kept by the pipeline
+COUNTS_ENTRY_BYTES = 120
+PROB_ENTRY_BYTES = 130
+
+def load_calibration(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def backend_model(calibration, provider, backend):
+    model = DEFAULT_MODEL.copy()
+    if calibration:
+        if backend in calibration:
+            model.update(calibration[backend])
+        elif f"{provider}/{backend}" in calibration:
+            model.update(calibration[f"{provider}/{backend}"])
+    return model
+
+def predict_job_time(model, stats, shots):
+    return model["job_overhead"] + shots * (model["shot_time"] + model["gate_time"] * stats["num_gates"] * 2**stats["qubits"])
+
+def sew_terms(cut_info):
+    #number of terms contracted by the sew: 4 per wire cut
+    if not cut_info:
+        return None
+    if "terms" in cut_info:
+        return sum(4**term["num_cuts"] for term in cut_info["terms"] if "num_cuts" in term)
+    if "num_cuts" in cut_info:
+        return 4**cut_info["num_cuts"]
+    return None
+
+def plan(
+    circuit,
+    observable_string,
+    shots,
+    provider_backend_couples,
+    cut_strategy_module,
+    shots_allocation_module,
+    sw_policy_module,
+    calibration = None
+    ):
+    times = {}
+
+    start = perf_counter()
+    cut_res = cut_strategy_module.cut(circuit, observable_string)
+    if len(cut_res)==3:
+        cut_output, sew_data, cut_info = cut_res
+    else:
+        cut_output, sew_data = cut_res
+        cut_info = None
+    vcs, old_vcs = prepare_fragments(cut_output)
+    times["time_cutting"] = perf_counter() - start
+
+    start = perf_counter()
+    vcs_shots = shots_allocation_module.allocate_shots(vcs, shots)
+    times["time_allocation"] = perf_counter() - start
+
+    start = perf_counter()
+    dispatch, split_coefficients = utils.create_policy_dispatch(vcs_shots, provider_backend_couples, sw_policy_module)
+    times["time_dispatch"] = perf_counter() - start
+
+    stats = {}
+    backends = {}
+    counts_bytes = 0
+    for provider in dispatch:
+        for backend in dispatch[provider]:
+            model = backend_model(calibration, provider, backend)
+            jobs = 0
+            backend_shots = 0
+            predicted_time = 0.0
+            for fragment, fragment_shots in dispatch[provider][backend]:
+                name = fragment.metadata["circuit_name"]+fragment.metadata["observable"]
+                if name not in stats:
+                    stats[name] = fragment.describe()
+                jobs += 1
+                backend_shots += fragment_shots
+                predicted_time += predict_job_time(model, stats[name], fragment_shots)
+                #one entry per measured state, at most one per shot
+                counts_bytes += min(fragment_shots, 2**stats[name]["qubits"]) * COUNTS_ENTRY_BYTES
+            backends[f"{provider}/{backend}"] = {
+                "jobs": jobs,
+                "shots": backend_shots,
+                "predicted_time": predicted_time,
+                "model": model,
+            }
+
+    probs_bytes = 0
+    for fragment, fragment_shots in vcs_shots:
+        name = fragment.metadata["circuit_name"]+fragment.metadata["observable"]
+        if name in stats:
+            probs_bytes += min(fragment_shots, 2**stats[name]["qubits"]) * PROB_ENTRY_BYTES
+    circuits_bytes = sum(len(vc.circuit) for vc in vcs) + sum(len(c) for c in set(old_vcs.values()))
+
+    return {
+        "cut_info": cut_info,
+        "num_variations": len(vcs),
+        "total_jobs": sum(b["jobs"] for b in backends.values()),
+        "total_shots": sum(b["shots"] for b in backends.values()),
+        "backends": backends,
+        #backends run concurrently
+        "predicted_execution_time": max([b["predicted_time"] for b in backends.values()], default=0.0),
+        "predicted_backend_time": sum(b["predicted_time"] for b in backends.values()),
+        "memory": {
+            "counts_bytes": counts_bytes,
+            "probs_bytes": probs_bytes,
+            "circuits_bytes": circuits_bytes,
+        },
+        "sew_terms": sew_terms(cut_info),
+        "split_coefficients": split_coefficients,
+        "times": times,
+    }
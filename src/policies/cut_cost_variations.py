@@ -0,0 +1,14 @@
+'''
+This file contains the implementation of the function for the cost model of a cut.
+The cost model must implement the following function:
+    - cost(candidate) -> cost
+        candidate: dictionary describing a cut, with the number of fragments (num_fragments), the number of wire cuts (num_cuts) and, for each fragment,
+            its number of qubits (fragments_qubits), its number of variations to execute (variations) and its number of 2-qubit gates (fragments_2q_gates)
+        cost: estimated cost of executing the fragments variations of the cut, lower is better
+'''
+def cost(candidate):
+    #each variation is a job whose backend time grows with the 2-qubit gates and exponentially with the qubits of the fragment
+    total = 0
+    for qubits, variations, gates_2q in zip(candidate["fragments_qubits"], candidate["variations"], candidate["fragments_2q_gates"]):
+        total += variations * (1 + gates_2q) * 2**qubits
+    return total
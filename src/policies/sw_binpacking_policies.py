@@ -0,0 +1,108 @@
+'''
+This file contains the implementation of the functions for the bin-packing shotwise policies.
+Instead of splitting the shots of every fragment among all the backends, whole fragment variations (or a few large slices of the most expensive ones)
+are assigned to the backends by bin-packing on their estimated cost, keeping the load of the backends balanced and reducing the number of jobs.
+The policies implement the following functions:
+    - split_fragments(backends, vcs_shots) -> (assignments, coefficients)
+        backends: list of tuples (provider, backend)
+        vcs_shots: list of tuples (fragment, shots), as returned by the shots allocation
+        assignments: list of tuples (fragment, provider, backend, shots)
+        coefficients: dictionary of dictionaries of floats, where coefficients[provider][backend] is the share of the shots sent to the backend
+    - split(backends, shots) -> (dispatch, coefficients)
+        the split of a single fragment, as in sw_fair_policies
+    - merge(counts) -> (probs, coefficients)
+        counts: dictionary of dictionaries of lists, where counts[provider][backend] is a list of tuples (circuit_id, observable, counts)
+        probs: dictionary of dictionaries of floats, where probs[(circuit_id,observable)][state] is the probability of measuring the state in the circuit
+        coefficients: dictionary of dictionaries of floats, where coefficients[provider][backend] is the share of the shots executed by the backend
+'''
+import heapq, math
+from policies.sw_fair_policies import split
+
+def estimate_cost(fragment, shots):
+    #the execution time of a shot grows with the gates and, on simulators, exponentially with the qubits
+    stats = fragment.describe()
+    return shots * (1 + stats["num_gates"]) * 2**stats["qubits"]
+
+def split_fragments(backends, vcs_shots):
+    slices = []
+    total_cost = 0
+    costs = []
+    for fragment, shots in vcs_shots:
+        cost = estimate_cost(fragment, shots) if shots > 0 else 0
+        costs.append(cost)
+        total_cost += cost
+    target = total_cost / len(backends) if total_cost > 0 else 0
+
+    for i, ((fragment, shots), cost) in enumerate(zip(vcs_shots, costs)):
+        #fragments more expensive than the load of a backend are split in a few large slices
+        n_slices = 1
+        if target > 0 and cost > target:
+            n_slices = min(len(backends), shots, math.ceil(cost / target))
+        for j in range(n_slices):
+            slice_shots = shots // n_slices + (1 if j < shots % n_slices else 0)
+            slices.append((cost * slice_shots / shots if shots > 0 else 0, i, slice_shots))
+
+    #longest processing time first, each slice goes to the least loaded backend not already running the fragment
+    slices.sort(key=lambda s: s[0], reverse=True)
+    loads = [(0, b) for b in range(len(backends))]
+    heapq.heapify(loads)
+    assigned = {}
+    for cost, i, slice_shots in slices:
+        skipped = []
+        load, b = heapq.heappop(loads)
+        while (i, b) in assigned and loads:
+            skipped.append((load, b))
+            load, b = heapq.heappop(loads)
+        if (i, b) in assigned:
+            #every backend already runs the fragment, the slice is merged with the one of the least loaded backend
+            skipped.append((load, b))
+            skipped.sort()
+            load, b = skipped.pop(0)
+        assigned[(i, b)] = assigned.get((i, b), 0) + slice_shots
+        heapq.heappush(loads, (load + cost, b))
+        for s in skipped:
+            heapq.heappush(loads, s)
+
+    assignments = []
+    backend_shots = [0]*len(backends)
+    for (i, b), slice_shots in assigned.items():
+        provider, backend = backends[b]
+        assignments.append((vcs_shots[i][0], provider, backend, slice_shots))
+        backend_shots[b] += slice_shots
+
+    total_shots = sum(backend_shots)
+    coefficients = {}
+    for (provider, backend), shots in zip(backends, backend_shots):
+        if provider not in coefficients:
+            coefficients[provider] = {}
+        coefficients[provider][backend] = shots / total_shots if total_shots > 0 else 0
+    return assignments, coefficients
+
+def merge(counts):
+    #the probabilities of a fragment are weighted by the shots executed on each backend, also when it ran on a single backend
+    probs = {}
+    backend_shots = {}
+    for provider in counts:
+        backend_shots[provider] = {}
+        for backend in counts[provider]:
+            backend_shots[provider][backend] = 0
+            for fragment_id, observable, fragment_counts in counts[provider][backend]:
+                if (fragment_id, observable) not in probs:
+                    probs[(fragment_id, observable)] = {}
+                for state,count in fragment_counts.items():
+                    if state not in probs[(fragment_id, observable)]:
+                        probs[(fragment_id, observable)][state] = 0
+                    probs[(fragment_id, observable)][state] += count
+                    backend_shots[provider][backend] += count
+    for fragment_id_obs in probs:
+        total = sum([probs[fragment_id_obs][state] for state in probs[fragment_id_obs]])
+        for state in probs[fragment_id_obs]:
+            probs[fragment_id_obs][state] /= total
+
+    total_shots = sum([sum(backend_shots[provider].values()) for provider in backend_shots])
+    coefficients = {}
+    for provider in backend_shots:
+        coefficients[provider] = {}
+        for backend in backend_shots[provider]:
+            coefficients[provider][backend] = backend_shots[provider][backend] / total_shots if total_shots > 0 else 0
+    return probs, coefficients
@@ -0,0 +1,364 @@
+'''
+This file implements a cutting tool working directly on the qiskit DAGCircuit of the circuit, an alternative to pennylane_tool that does not convert
+the circuit to a PennyLane tape nor partitions it with KaHyPar. It implements the same interface of pennylane_tool:
+    - cut: cut(circuit, observable_string) -> output, cut_data, cut_info
+    - sew: sew(qasm_obs_expvals, sew_data)  -> results
+
+Wire cuts are placed by a greedy heuristic: the gates are visited in topological order and the wire segments they touch are merged (with a union-find)
+into fragments of at most max_width qubits; when a 2-qubit gate would exceed the width, one of its wires is cut and the new segment of the wire joins
+the fragment of the other one. Every max_width up to the qubits of the circuit, i.e. the uncut circuit, is tried (unless fixed by the module variable
+max_width) and the cut with the lowest cost is kept; the cost
+model is the one of pennylane_search_tool (cost_module, policies/cut_cost_variations.py by default).
+
+The state of a cut wire is decomposed as
+    rho = 1/2 sum_{O in I, X, Y, Z} Tr(O rho) O
+the fragment before the cut measures O, the fragment after the cut is prepared in the states 0, 1, +, +i, since
+    I = |0><0| + |1><1|    Z = |0><0| - |1><1|    X = 2|+><+| - |0><0| - |1><1|    Y = 2|+i><+i| - |0><0| - |1><1|
+The sew contracts the expected values of the fragment variations with numpy.einsum. Variations whose observable is the identity are not executed.
+
+With many cuts the exact sew needs all the 16**k variations of k cuts: cut_sampled and sew_sampled implement its Monte Carlo version, where every shot
+samples a term of the decomposition (with probability proportional to the absolute value of its coefficient) and only the sampled variations are executed.
+Each sample is worth gamma times the sign of its coefficients and the product of the expected values of its fragments, with gamma = 6**k (times the
+sum of the absolute coefficients of a Pauli sum): sew_sampled returns the mean of the samples and its standard error, which grows as gamma / sqrt(N)
+and accounts for both the sampling of the terms and the shot noise of the expected values of the sampled variations.
+'''
+import importlib
+from itertools import product
+import numpy as np
+from utils import observable_terms
+
+DEFAULT_COST_MODULE = "policies.cut_cost_variations"
+cost_module = None
+max_width = None
+
+CUT_OBSERVABLES = ["I", "X", "Y", "Z"]
+PREPARATIONS = ["0", "1", "+", "+i"]
+PREPARATION_GATES = {"0": [], "1": ["x"], "+": ["h"], "+i": ["h", "s"]}
+#PREPARATION_COEFFICIENTS[O][state]: coefficient of the state in the decomposition of the observable O
+PREPARATION_COEFFICIENTS = np.array([
+    [1, 1, 0, 0],
+    [-1, -1, 2, 0],
+    [-1, -1, 0, 2],
+    [1, -1, 0, 0],
+])
+
+#terms of the decomposition of a cut wire with a non-zero coefficient: (observable, preparation, coefficient)
+CUT_TERMS = [(o, p, 0.5*PREPARATION_COEFFICIENTS[o][p]) for o in range(len(CUT_OBSERVABLES)) for p in range(len(PREPARATIONS)) if PREPARATION_COEFFICIENTS[o][p] != 0]
+#sampling overhead of a cut, the sum of the absolute coefficients of its terms (6)
+CUT_GAMMA = sum(abs(coeff) for _, _, coeff in CUT_TERMS)
+
+#operations that are not part of the unitary of the circuit, the measurements are added by the pipeline
+SKIPPED_OPERATIONS = {"measure", "barrier", "delay"}
+
+
+def circuit_ops(dag):
+    #operations of the circuit in topological order, with the indices of their qubits
+    qubit_index = {q: i for i, q in enumerate(dag.qubits)}
+    ops = []
+    for node in dag.topological_op_nodes():
+        if node.op.name in SKIPPED_OPERATIONS:
+            continue
+        if node.op.name == "reset":
+            raise ValueError("Circuits with resets cannot be cut")
+        if len(node.qargs) > 2:
+            raise ValueError(f"Operation {node.op.name} on more than 2 qubits, the circuit must be decomposed")
+        ops.append((node.op, [qubit_index[q] for q in node.qargs]))
+    return ops
+
+def greedy_cuts(ops, num_qubits, width):
+    #a segment is a piece of wire between two cuts, the fragments are the connected components of the segments
+    parent = list(range(num_qubits))
+    size = [1]*num_qubits
+    segment = list(range(num_qubits))
+    cuts = []
+    op_segments = []
+
+    def find(s):
+        while parent[s] != s:
+            parent[s] = parent[parent[s]]
+            s = parent[s]
+        return s
+
+    def cut_wire(q):
+        parent.append(len(parent))
+        size.append(1)
+        cuts.append((segment[q], len(parent)-1))
+        segment[q] = len(parent)-1
+
+    for _, qubits in ops:
+        if len(qubits) == 2:
+            a, b = qubits
+            ra, rb = find(segment[a]), find(segment[b])
+            if ra != rb and size[ra]+size[rb] > width:
+                #the wire of the smaller fragment moves to the other one, both wires are cut if both fragments are full
+                if size[rb] < width and (size[rb] <= size[ra] or size[ra] >= width):
+                    cut_wire(a)
+                elif size[ra] < width:
+                    cut_wire(b)
+                else:
+                    cut_wire(a)
+                    cut_wire(b)
+                ra, rb = find(segment[a]), find(segment[b])
+            if ra != rb:
+                parent[rb] = ra
+                size[ra] += size[rb]
+        op_segments.append([segment[q] for q in qubits])
+
+    fragment_of = [find(s) for s in range(len(parent))]
+    return op_segments, cuts, fragment_of, segment
+
+def extract_fragments(ops, op_segments, cuts, fragment_of, final_segments):
+    #fragments[f]: segments (local qubits) of the fragment, its operations on the local qubits and its incoming and outgoing cuts
+    roots = sorted(set(fragment_of), key=fragment_of.index)
+    fragment_index = {root: f for f, root in enumerate(roots)}
+    fragments = [{"segments": [], "ops": [], "incoming": [], "outgoing": []} for _ in roots]
+    local = {}
+    for s, root in enumerate(fragment_of):
+        fragment = fragments[fragment_index[root]]
+        local[s] = len(fragment["segments"])
+        fragment["segments"].append(s)
+    for (op, _), segments in zip(ops, op_segments):
+        fragments[fragment_index[fragment_of[segments[0]]]]["ops"].append((op, [local[s] for s in segments]))
+    for k, (old, new) in enumerate(cuts):
+        fragments[fragment_index[fragment_of[old]]]["outgoing"].append(k)
+        fragments[fragment_index[fragment_of[new]]]["incoming"].append(k)
+    qubit_of_segment = {s: q for q, s in enumerate(final_segments)}
+    for fragment in fragments:
+        fragment["local"] = {s: local[s] for s in fragment["segments"]}
+        fragment["output_qubits"] = [qubit_of_segment.get(s) for s in fragment["segments"]]
+    return fragments
+
+def cut_candidate(ops, num_qubits, width):
+    op_segments, cuts, fragment_of, final_segments = greedy_cuts(ops, num_qubits, width)
+    fragments = extract_fragments(ops, op_segments, cuts, fragment_of, final_segments)
+    candidate = {
+        "max_width": width,
+        "num_fragments": len(fragments),
+        "num_cuts": len(cuts),
+        "fragments_qubits": [len(f["segments"]) for f in fragments],
+        "variations": [4**(len(f["incoming"])+len(f["outgoing"])) for f in fragments],
+        "fragments_2q_gates": [sum(1 for _, qubits in f["ops"] if len(qubits) == 2) for f in fragments],
+    }
+    return fragments, cuts, candidate
+
+def search_cut(ops, num_qubits):
+    module = cost_module if cost_module is not None else importlib.import_module(DEFAULT_COST_MODULE)
+    #width num_qubits is the uncut circuit, kept when the cost model prefers it
+    widths = [max_width] if max_width is not None else range(min(2, num_qubits), num_qubits+1)
+    best = None
+    for width in widths:
+        fragments, cuts, candidate = cut_candidate(ops, num_qubits, width)
+        candidate_cost = module.cost(candidate)
+        #fewer cuts on ties
+        if best is None or (candidate_cost, candidate["num_cuts"]) < (best[0], best[1]):
+            best = (candidate_cost, candidate["num_cuts"], fragments, cuts, candidate)
+    return best[2], best[3], best[4]
+
+def fragment_circuits(fragment):
+    #QASM of the fragment for each preparation of its incoming cuts, the gates of the fragment are exported once
+    from qiskit import QuantumCircuit, qasm2  # type: ignore
+    qc = QuantumCircuit(len(fragment["segments"]))
+    for op, qubits in fragment["ops"]:
+        qc.append(op, [qc.qubits[q] for q in qubits])
+    qasm = qasm2.dumps(qc)
+    #the preparations go right after the declaration of the register
+    start = qasm.index("qreg")
+    start = qasm.index("\n", start)+1
+    circuits = []
+    for preparation in product(range(len(PREPARATIONS)), repeat=len(fragment["incoming"])):
+        lines = []
+        for k, p in zip(fragment["incoming"], preparation):
+            qubit = fragment["prepared"][k]
+            lines += [f"{gate} q[{qubit}];\n" for gate in PREPARATION_GATES[PREPARATIONS[p]]]
+        circuits.append(qasm[:start]+"".join(lines)+qasm[start:])
+    return circuits
+
+def fragment_observables(fragment, measured, pauli):
+    #observables of the fragment for each measurement of its outgoing cuts, None for the identity
+    observables = []
+    for measurement in product(range(len(CUT_OBSERVABLES)), repeat=len(fragment["outgoing"])):
+        obs = ["I"]*len(fragment["segments"])
+        for q, qubit in enumerate(fragment["output_qubits"]):
+            if qubit is not None:
+                obs[q] = pauli[qubit]
+        for k, m in zip(fragment["outgoing"], measurement):
+            obs[measured[k]] = CUT_OBSERVABLES[m]
+        obs = "".join(obs)
+        observables.append(None if set(obs) == {"I"} else obs)
+    return observables
+
+def prepare_cut(circuit, observable_string):
+    #cuts the circuit and exports the QASM of the fragments for every preparation, the observable is applied by cut and cut_sampled
+    from qiskit import QuantumCircuit  # type: ignore
+    from qiskit.converters import circuit_to_dag  # type: ignore
+    qc = QuantumCircuit.from_qasm_str(circuit)
+    while any(len(instruction.qubits) > 2 for instruction in qc.data if instruction.operation.name not in SKIPPED_OPERATIONS):
+        qc = qc.decompose()
+    dag = circuit_to_dag(qc)
+    terms = observable_terms(observable_string)
+    if any(len(pauli) != dag.num_qubits() for _, pauli in terms):
+        raise ValueError(f"The observable {observable_string} does not match the {dag.num_qubits()} qubits of the circuit")
+    constant = sum(coeff for coeff, pauli in terms if set(pauli) == {"I"})
+    terms = [(coeff, pauli) for coeff, pauli in terms if set(pauli) != {"I"}]
+    if not terms:
+        raise ValueError("The observable has no term to measure")
+
+    fragments, cuts, candidate = search_cut(circuit_ops(dag), dag.num_qubits())
+
+    #local qubit of each cut wire in the fragment measuring it and in the fragment preparing it
+    measured = {}
+    for fragment in fragments:
+        fragment["prepared"] = {k: fragment["local"][cuts[k][1]] for k in fragment["incoming"]}
+        for k in fragment["outgoing"]:
+            measured[k] = fragment["local"][cuts[k][0]]
+    circuits = []
+    fragments_circuits = []
+    for fragment in fragments:
+        fragments_circuits.append(list(range(len(circuits), len(circuits)+len(PREPARATIONS)**len(fragment["incoming"]))))
+        circuits += fragment_circuits(fragment)
+    return fragments, cuts, candidate, measured, circuits, fragments_circuits, terms, constant
+
+def get_cut_info(candidate, output):
+    return {
+        "num_fragments": candidate["num_fragments"],
+        "fragments_qubits": candidate["fragments_qubits"],
+        "num_cuts": candidate["num_cuts"],
+        "fragments_2q_gates": candidate["fragments_2q_gates"],
+        "max_width": candidate["max_width"],
+        "num_variations": sum(len(observables) for _, observables in output),
+    }
+
+def cut(circuit, observable_string):
+    fragments, cuts, candidate, measured, circuits, fragments_circuits, terms, constant = prepare_cut(circuit, observable_string)
+
+    #fragment variations are shared between the terms
+    output_observables = [[] for _ in circuits]
+    terms_sew_data = []
+    terms_info = []
+    for coeff, pauli in terms:
+        term_fragments = []
+        num_variations = 0
+        for fragment, fragment_circuits_indices in zip(fragments, fragments_circuits):
+            observables = fragment_observables(fragment, measured, pauli)
+            entries = []
+            for c in fragment_circuits_indices:
+                for obs in observables:
+                    entries.append((c, obs))
+                    if obs is not None:
+                        num_variations += 1
+                        if obs not in output_observables[c]:
+                            output_observables[c].append(obs)
+            term_fragments.append({"incoming": fragment["incoming"], "outgoing": fragment["outgoing"], "entries": entries})
+        terms_sew_data.append((coeff, {"circuits": circuits, "num_cuts": len(cuts), "fragments": term_fragments}))
+        terms_info.append({"observable": pauli, "coefficient": coeff, "num_cuts": len(cuts), "num_variations": num_variations})
+
+    output = [(qasm, observables) for qasm, observables in zip(circuits, output_observables) if observables]
+    cut_info = get_cut_info(candidate, output)
+    if len(terms) == 1 and constant == 0 and terms[0][0] == 1.0:
+        return output, terms_sew_data[0][1], cut_info
+    cut_info["num_variations_unshared"] = sum(info["num_variations"] for info in terms_info)
+    cut_info["num_terms"] = len(terms)
+    cut_info["terms"] = terms_info
+    return output, {"constant": constant, "terms": terms_sew_data}, cut_info
+
+def cut_sampled(circuit, observable_string, shots, seed=None):
+    #Monte Carlo version of cut: each of the shots samples a term of the observable and a term of the decomposition of every cut, with probability
+    #proportional to the absolute value of its coefficient; only the sampled variations are executed, each one with a shot for each time it is sampled
+    #returns also variation_shots: dictionary (fragment, observable) -> shots
+    fragments, cuts, candidate, measured, circuits, fragments_circuits, terms, constant = prepare_cut(circuit, observable_string)
+    rng = np.random.default_rng(seed)
+    weights = np.array([abs(coeff) for coeff, _ in terms])
+    gamma = CUT_GAMMA**len(cuts) * weights.sum()
+    samples = np.column_stack([
+        rng.choice(len(terms), size=shots, p=weights/weights.sum()),
+        rng.choice(len(CUT_TERMS), size=(shots, len(cuts)), p=np.array([abs(coeff) for _, _, coeff in CUT_TERMS])/CUT_GAMMA),
+    ])
+    sampled, counts = np.unique(samples, axis=0, return_counts=True)
+
+    observables = {}
+    variation_shots = {}
+    sampled_terms = []
+    for sample, n in zip(sampled, counts):
+        coeff, pauli = terms[sample[0]]
+        cut_terms = [CUT_TERMS[i] for i in sample[1:]]
+        sign = float(np.sign(coeff) * np.prod([np.sign(c) for _, _, c in cut_terms]))
+        entries = []
+        for f, fragment in enumerate(fragments):
+            if (f, sample[0]) not in observables:
+                observables[(f, sample[0])] = fragment_observables(fragment, measured, pauli)
+            #the variations are in the order of itertools.product over the cuts (see fragment_circuits and fragment_observables)
+            c = 0
+            for k in fragment["incoming"]:
+                c = c*len(PREPARATIONS) + cut_terms[k][1]
+            o = 0
+            for k in fragment["outgoing"]:
+                o = o*len(CUT_OBSERVABLES) + cut_terms[k][0]
+            c = fragments_circuits[f][c]
+            obs = observables[(f, sample[0])][o]
+            entries.append((c, obs))
+            if obs is not None:
+                variation_shots[(c, obs)] = variation_shots.get((c, obs), 0) + int(n)
+        sampled_terms.append((int(n), sign, entries))
+
+    output_observables = {}
+    for c, obs in variation_shots:
+        output_observables.setdefault(c, []).append(obs)
+    output = [(circuits[c], output_observables[c]) for c in sorted(output_observables)]
+    sew_data = {"circuits": circuits, "constant": constant, "gamma": gamma, "samples": shots, "sampled": sampled_terms}
+    cut_info = get_cut_info(candidate, output)
+    cut_info["gamma"] = gamma
+    cut_info["num_sampled_terms"] = len(sampled_terms)
+    return output, sew_data, cut_info, {(circuits[c], obs): n for (c, obs), n in variation_shots.items()}
+
+def sew_sampled(qasm_obs_expvals, sew_data):
+    #estimate of the expected value, with its standard error: every sample is worth gamma * sign * the product of the values of its fragments.
+    #The variance is the one of the sampling of the terms plus the shot noise of the values, propagated to first order: the value of a variation
+    #executed with m shots (one for each sample containing it) has the binomial variance (1 - value**2) / m
+    circuits = sew_data["circuits"]
+    total = 0.0
+    total_squares = 0.0
+    variation_shots = {}
+    #derivative of the sum of the samples with respect to the value of each variation
+    derivatives = {}
+    for n, sign, entries in sew_data["sampled"]:
+        variations = [(c, obs) for c, obs in entries if obs is not None]
+        values = [qasm_obs_expvals[(circuits[c], obs)] for c, obs in variations]
+        value = sign * np.prod(values)
+        total += n*value
+        total_squares += n*value**2
+        for i, variation in enumerate(variations):
+            variation_shots[variation] = variation_shots.get(variation, 0) + n
+            derivatives[variation] = derivatives.get(variation, 0.0) + n * sign * np.prod(values[:i] + values[i+1:])
+    gamma = sew_data["gamma"]
+    samples = sew_data["samples"]
+    mean = gamma * total / samples
+    sampling_variance = (gamma**2 * total_squares / samples - mean**2) / max(samples - 1, 1)
+    shot_variance = 0.0
+    for (c, obs), m in variation_shots.items():
+        value = qasm_obs_expvals[(circuits[c], obs)]
+        shot_variance += (gamma * derivatives[(c, obs)] / samples)**2 * max(1.0 - value**2, 0.0) / m
+    standard_error = np.sqrt(max(sampling_variance, 0.0) + shot_variance)
+    return sew_data["constant"] + mean, float(standard_error)
+
+def sew(qasm_obs_expvals, sew_data):
+    if "sampled" in sew_data:
+        return sew_sampled(qasm_obs_expvals, sew_data)[0]
+    if "terms" in sew_data:
+        #weighted sum of the terms of a Pauli-sum observable
+        result = sew_data["constant"]
+        for coeff, term_sew_data in sew_data["terms"]:
+            result = result + coeff * sew(qasm_obs_expvals, term_sew_data)
+        return result
+
+    circuits = sew_data["circuits"]
+    num_cuts = sew_data["num_cuts"]
+    #axes of the einsum: k is the observable measured on the cut k, num_cuts+k the state prepared after it
+    operands = []
+    for fragment in sew_data["fragments"]:
+        values = [1.0 if obs is None else qasm_obs_expvals[(circuits[c], obs)] for c, obs in fragment["entries"]]
+        axes = [num_cuts+k for k in fragment["incoming"]] + list(fragment["outgoing"])
+        operands += [np.array(values, dtype=float).reshape((len(PREPARATIONS),)*len(axes)), axes]
+    for k in range(num_cuts):
+        operands += [PREPARATION_COEFFICIENTS, [k, num_cuts+k]]
+    #the contraction order matters, a plain einsum iterates over all the 16**num_cuts index combinations
+    return float(np.einsum(*operands, [], optimize="greedy")) * 0.5**num_cuts
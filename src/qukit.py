@@ -1,11 +1,12 @@
-import threading, json
+import threading, json, logging, collections, statistics, os
+from time import perf_counter, sleep
+import emulator
 from typing import Any, Optional
-from qiskit import QuantumCircuit  # type: ignore
-from qiskit_aer import AerProvider, AerSimulator  # type: ignore
-from qiskit_aer.noise import NoiseModel  # type: ignore
-from qiskit_ibm_runtime import QiskitRuntimeService, SamplerV2  # type: ignore
-from qiskit_ibm_runtime.fake_provider import FakeProviderForBackendV2  # type: ignore
-from qiskit_ibm_runtime.fake_provider.fake_backend import FakeBackendV2  # type: ignore
+
+# Provider SDKs (qiskit, qiskit_aer, qiskit_ibm_runtime) are imported inside the functions that use them,
+# so that importing this module (and the CLI) does not pay for frameworks the configured run never touches.
+
+logger = logging.getLogger("cutnshot")
 
 
 class ThreadWithReturnValue(threading.Thread):
@@ -125,6 +126,22 @@ class ThreadWithReturnValue(threading.Thread):
         """
         return self._exc
 
+def circuit_stats(qc):
+    d = {}
+    d["qubits"] = qc.num_qubits
+    d["depth"] = qc.depth()
+    d["num_gates"] = qc.size()
+    
+    d["2q_depth"] = qc.depth(filter_function=lambda x: x.operation.num_qubits == 2)
+    
+    d['num_1q_gates'] = sum(1 for op in qc.data if op.operation.num_qubits == 1)
+    d['num_2q_gates'] = sum(1 for op in qc.data if op.operation.num_qubits == 2)
+    d['num_measurements'] = sum(1 for op in qc.data if op.operation.name == 'measure')
+    
+    d["gates"] = dict(qc.count_ops())
+    
+    return d.copy()
+
 class VirtualCircuit:
     
     def __init__(self, circuit, metadata = {}):
@@ -141,24 +158,70 @@ class VirtualCircuit:
         return cls(circuit=data["circuit"], metadata=data["metadata"])
     
     def describe(self):
-        d = {}
+        #stats given by the cutting tool, without parsing the circuit
+        if "stats" in self.metadata:
+            return self.metadata["stats"].copy()
+        from qiskit import QuantumCircuit  # type: ignore
         qc = QuantumCircuit.from_qasm_str(self.circuit)
-        
-        d["qubits"] = qc.num_qubits
-        d["depth"] = qc.depth()
-        d["num_gates"] = qc.size()
-        
-        d["2q_depth"] = qc.depth(filter_function=lambda x: x.operation.num_qubits == 2)
-        
-        d['num_1q_gates'] = sum(1 for op in qc.data if op.operation.num_qubits == 1)
-        d['num_2q_gates'] = sum(1 for op in qc.data if op.operation.num_qubits == 2)
-        d['num_measurements'] = sum(1 for op in qc.data if op.operation.name == 'measure')
-        
-        d["gates"] = dict(qc.count_ops())
-        
-        return d.copy()
-        
-        
+        return circuit_stats(qc)
+
+
+#the QASM of the lazy circuits is exported by a single thread of the process, the cutting tools (e.g. PennyLane) are not thread-safe: the exports
+#are serialized with each other and, within a pipeline, run while its main thread only waits for the execution of the dispatch (see
+#cutnshot.schedule_exports). Other pipelines running in threads of the same process are not serialized with them, the service runs one pipeline
+#per process (see service.py)
+_export_executor = None
+_export_pid = None
+_export_lock = threading.Lock()
+
+def export_executor():
+    global _export_executor, _export_pid
+    with _export_lock:
+        #a forked process does not inherit the thread of its parent
+        if _export_executor is None or _export_pid != os.getpid():
+            from concurrent.futures import ThreadPoolExecutor
+            _export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qasm-export")
+            _export_pid = os.getpid()
+        return _export_executor
+
+
+class LazyVirtualCircuit(VirtualCircuit):
+    """VirtualCircuit whose QASM export is deferred until it is needed.
+
+    The shots allocation and the split only use the metadata of the circuits (see VirtualCircuit.describe), the QASM
+    is exported when the circuit is executed, or scheduled ahead of the execution by materialize. Every export runs on
+    the export thread of the process (see export_executor).
+
+    Parameters
+    ----------
+    circuit_fun : callable
+        The function returning the QASM of the circuit.
+    metadata : dict
+        The metadata of the circuit.
+    """
+
+    def __init__(self, circuit_fun, metadata = {}):
+        self._circuit_fun = circuit_fun
+        self._export = None
+        self._lock = threading.Lock()
+        self.metadata = metadata.copy()
+
+    @property
+    def circuit(self):
+        return self.materialize().result()
+
+    def materialize(self):
+        #schedules the export on the export thread, once per process, and returns its future
+        with self._lock:
+            if self._export is None or (self._export[0] != os.getpid() and not self._export[1].done()):
+                self._export = (os.getpid(), export_executor().submit(self._circuit_fun))
+            return self._export[1]
+
+    def __reduce__(self):
+        #e.g. to send the circuit to another process, it is materialized
+        return (VirtualCircuit, (self.circuit, self.metadata))
+
+
 class Job:
     def __init__(self, backend, results):
         self.backend = backend
@@ -176,19 +239,22 @@ class Job:
         return cls(backend=data["backend"], results=results)
         
 class Result:
-    def __init__(self, circuit, counts):
+    def __init__(self, circuit, counts, info=None):
         self.circuit = circuit
         self.counts = counts
+        #information about the execution, e.g. the simulation method
+        self.info = info if info is not None else {}
 
     def to_dict(self):
         return {
             "circuit": self.circuit,
             "counts": self.counts,
+            "info": self.info,
         }
 
     @classmethod
     def from_dict(cls, data):
-        return cls(circuit=data["circuit"], counts=data["counts"])
+        return cls(circuit=data["circuit"], counts=data["counts"], info=data.get("info", None))
 
 class QukitJSONEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -209,27 +275,471 @@ class QukitJSONEncoder(json.JSONEncoder):
             return VirtualCircuit.from_dict(data)
         return data
 
-def run_circuits_on_backend(backend, circuits):
+class CountsAccumulator:
+    """Accumulates the counts of several executions of the same circuit.
+
+    States are stored as integers, so the memory used is bounded by the number of distinct states measured,
+    whatever the number of shots. The spaces separating the classical registers are restored in the returned bitstrings.
+    """
+
+    def __init__(self) -> None:
+        self.counts: dict = {}
+        self.width = 0
+        self.separators: list = []
+
+    def add(self, counts: dict) -> None:
+        """Add the counts of an execution.
+
+        Parameters
+        ----------
+        counts : dict
+            The counts, bitstring -> number of shots.
+        """
+        for state, count in counts.items():
+            bits = state.replace(" ", "")
+            if not self.width:
+                #positions of the register separators, taken from the first state
+                self.separators = [i - n for n, i in enumerate(i for i, c in enumerate(state) if c == " ")]
+            self.width = max(self.width, len(bits))
+            key = int(bits, 2)
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def to_counts(self) -> dict:
+        """Return the accumulated counts.
+
+        Returns
+        -------
+        dict
+            The counts, bitstring -> number of shots.
+        """
+        return {self._layout(format(state, f"0{self.width}b")): count for state, count in self.counts.items()}
+
+    def _layout(self, bits: str) -> str:
+        for position in reversed(self.separators):
+            bits = bits[:position] + " " + bits[position:]
+        return bits
+
+CLIFFORD_GATES = {"id", "x", "y", "z", "h", "s", "sdg", "sx", "sxdg", "cx", "cy", "cz", "swap", "measure", "barrier", "reset"}
+DENSITY_MATRIX_MAX_QUBITS = 12
+STATEVECTOR_MAX_QUBITS = 28
+FUSION_MIN_DEPTH = 16
+
+def select_simulation_method(stats, noisy):
+    """Choose the Aer simulation method, and its options, for a circuit.
+
+    Parameters
+    ----------
+    stats : dict
+        The stats of the circuit, as returned by circuit_stats.
+    noisy : bool
+        Whether the simulator has a noise model.
+
+    Returns
+    -------
+    dict
+        The run options of the AerSimulator.
+    """
+    qubits = stats["qubits"]
+    clifford = all(gate in CLIFFORD_GATES for gate in stats["gates"])
+    if clifford and not noisy:
+        return {"method": "stabilizer"}
+    if noisy and qubits <= DENSITY_MATRIX_MAX_QUBITS:
+        #the noisy state is simulated once for all the shots, instead of a trajectory per shot
+        return {"method": "density_matrix"}
+    if qubits <= STATEVECTOR_MAX_QUBITS:
+        options = {"method": "statevector"}
+        if stats["depth"] >= FUSION_MIN_DEPTH:
+            #deep circuits gain from fusing gates even on few qubits (Aer fuses only from 14 qubits by default)
+            options["fusion_enable"] = True
+            options["fusion_threshold"] = min(qubits, 14)
+        return options
+    return {"method": "matrix_product_state"}
+
+def aer_run_options(noise_backend=None, auto_simulation_method=False):
+    #noise_backend: the fake backend whose noise is simulated, None for a noiseless simulation
+    def options_fun(qc):
+        options = {}
+        info = {}
+        if auto_simulation_method:
+            options = select_simulation_method(circuit_stats(qc), noise_backend is not None)
+            info["simulation"] = options.copy()
+        if noise_backend is not None:
+            #fragments are executed without a layout: the virtual qubit i is the physical qubit i of the device
+            qubits = tuple(range(qc.num_qubits))
+            options["noise_model"] = get_noise_model(noise_backend, qubits)
+            info["noise_qubits"] = list(qubits)
+        return options, info
+    return options_fun
+
+def check_shot_chunk_size(shot_chunk_size):
+    #None for no limit, otherwise a positive number of shots
+    if shot_chunk_size is not None and shot_chunk_size <= 0:
+        raise ValueError(f"shot_chunk_size must be a positive number of shots, got {shot_chunk_size}")
+    return shot_chunk_size
+
+def shot_chunks(shots, shot_chunk_size):
+    chunks = [shot_chunk_size] * (shots // shot_chunk_size)
+    if shots % shot_chunk_size:
+        chunks.append(shots % shot_chunk_size)
+    return chunks
+
+# A job failed by the provider (its result is None, e.g. on an emulated backend, see emulator.py) is resubmitted with an exponential
+# backoff: the whole execution is restarted by cutnshot.execute only when all the attempts of a job fail.
+MAX_JOB_ATTEMPTS = 3
+JOB_RETRY_BACKOFF = 1.0
+
+class CancelToken:
+    """Cancellation of the jobs submitted by run_circuits_on_backend, e.g. the losing copy of a speculative job.
+
+    The job running when the token is cancelled is cancelled on the provider, if its backend supports it, and no other job is submitted.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._job = None
+        self._lock = threading.Lock()
+
+    def submitted(self, job):
+        with self._lock:
+            self._job = job
+            if self.cancelled:
+                self._cancel_job()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            self._cancel_job()
+
+    def _cancel_job(self):
+        cancel = getattr(self._job, "cancel", None)
+        if cancel is not None:
+            try:
+                cancel()
+            except Exception:  # pylint: disable=broad-except
+                #the job could not be cancelled, e.g. it already completed: its result is ignored
+                logger.debug("The job could not be cancelled", exc_info=True)
+
+def run_job(backend, qc, shots, run_options, max_job_attempts=MAX_JOB_ATTEMPTS, cancel_token=None):
+    #result of the job, None if all its attempts failed or it was cancelled, and the time spent by the attempts in the queue of the provider
+    #(None if not reported)
+    queue_time = None
+    for attempt in range(1, max_job_attempts+1):
+        if cancel_token is not None and cancel_token.cancelled:
+            return None, queue_time
+        job = backend.run(qc, shots=shots, **run_options)
+        if cancel_token is not None:
+            cancel_token.submitted(job)
+        try:
+            result = job.result()
+        except Exception:  # pylint: disable=broad-except
+            if cancel_token is None or not cancel_token.cancelled:
+                raise
+            result = None
+        if hasattr(job, "queue_time"):
+            queue_time = (queue_time or 0.0) + job.queue_time
+        if result is not None:
+            return result, queue_time
+        if cancel_token is not None and cancel_token.cancelled:
+            return None, queue_time
+        logger.warning(f"{getattr(backend, 'name', str(backend))}: job of {shots} shots failed (attempt {attempt}/{max_job_attempts})")
+        if attempt < max_job_attempts:
+            sleep(JOB_RETRY_BACKOFF * 2**(attempt-1))
+    return None, queue_time
+
+def run_circuits_on_backend(backend, circuits, shot_chunk_size=None, options_fun=None, max_job_attempts=MAX_JOB_ATTEMPTS, cancel_token=None):
+    from qiskit import QuantumCircuit  # type: ignore
     results = []
+    backend_name = getattr(backend, "name", str(backend))
+    total_shots = sum(shots for _, shots in circuits)
+    done_shots = 0
     for circuit,shots in circuits:
         qc = QuantumCircuit.from_qasm_str(circuit.circuit)
-        result = backend.run(qc, shots=shots).result()
-        results.append(Job(backend, [Result(circuit, result.get_counts())]))
+        #options_fun gives the run options for the circuit, and the info to record about them
+        run_options, info = options_fun(qc) if options_fun is not None else ({}, {})
+        job_start = perf_counter()
+        queue_time = None
+        if not shot_chunk_size or shots <= shot_chunk_size:
+            result, queue_time = run_job(backend, qc, shots, run_options, max_job_attempts, cancel_token)
+            counts = result.get_counts() if result is not None else None
+            done_shots += shots
+        else:
+            #large shot requests are split in chunks, whose counts are aggregated as they arrive
+            accumulator = CountsAccumulator()
+            for chunk in shot_chunks(shots, shot_chunk_size):
+                result, chunk_queue_time = run_job(backend, qc, chunk, run_options, max_job_attempts, cancel_token)
+                if chunk_queue_time is not None:
+                    queue_time = (queue_time or 0.0) + chunk_queue_time
+                if result is None:
+                    accumulator = None
+                    break
+                accumulator.add(result.get_counts())
+                del result
+                done_shots += chunk
+                logger.debug(f"{backend_name}: {done_shots}/{total_shots} shots executed")
+            counts = accumulator.to_counts() if accumulator is not None else None
+        if counts is None:
+            if cancel_token is not None and cancel_token.cancelled:
+                results.append(None)
+                continue
+            #every attempt of the job failed: the execution is restarted by cutnshot.execute
+            logger.warning(f"{backend_name}: job {len(results)+1}/{len(circuits)} failed {max_job_attempts} times")
+            results.append(None)
+            continue
+        #wall-clock time of the job, with its size, e.g. to calibrate the planner (see ledger.py)
+        info.update({"time": perf_counter() - job_start, "shots": shots, "qubits": qc.num_qubits, "num_gates": qc.size()})
+        if queue_time is not None:
+            #time spent by the jobs in the queue of the provider, included in the time
+            info["queue_time"] = queue_time
+        logger.debug(f"{backend_name}: {len(results)+1}/{len(circuits)} circuits, {done_shots}/{total_shots} shots executed")
+        results.append(Job(backend, [Result(circuit, counts, info)]))
         
     return results
     
+# Noise models are expensive to build (NoiseModel.from_backend parses the whole device), and they do not change
+# during the life of the process: they are built once per backend and shared by every Dispatcher.
+# A fragment uses a few qubits of the device, it is executed with the noise model restricted to them: the reduced
+# models are cached per (backend, qubits), the noise of the used qubits is the same of the full model.
+_noise_models = {}
+_noise_models_lock = threading.Lock()
+_untrimmed_backends = set()
+
+# NoiseModel has no public API to read its errors: the trimming reads the attributes of the Aer versions it was written for
+# (qiskit-aer is pinned in requirements.txt), with other versions the fragments are executed with the full noise model.
+TRIM_NOISE_AER_VERSIONS = ("0.14.",)
+TRIM_NOISE_ATTRIBUTES = ["_default_quantum_errors", "_default_readout_error", "_local_quantum_errors", "_local_readout_errors", "_custom_noise_passes"]
+
+def can_trim_noise_model(noise_model):
+    import qiskit_aer  # type: ignore
+    return qiskit_aer.__version__.startswith(TRIM_NOISE_AER_VERSIONS) and all(hasattr(noise_model, a) for a in TRIM_NOISE_ATTRIBUTES)
+
+def trim_noise_model(noise_model, qubits):
+    from qiskit_aer.noise import NoiseModel  # type: ignore
+    qubits = set(qubits)
+    trimmed = NoiseModel(basis_gates=noise_model.basis_gates)
+    for instruction, error in noise_model._default_quantum_errors.items():
+        trimmed.add_all_qubit_quantum_error(error, instruction)
+    if noise_model._default_readout_error is not None:
+        trimmed.add_all_qubit_readout_error(noise_model._default_readout_error)
+    for instruction, errors in noise_model._local_quantum_errors.items():
+        for error_qubits, error in errors.items():
+            if set(error_qubits) <= qubits:
+                trimmed.add_quantum_error(error, instruction, error_qubits)
+    for error_qubits, error in noise_model._local_readout_errors.items():
+        if set(error_qubits) <= qubits:
+            trimmed.add_readout_error(error, error_qubits)
+    #e.g. the relaxation of the delays, indexed by physical qubit
+    trimmed._custom_noise_passes = list(noise_model._custom_noise_passes)
+    return trimmed
+
+def get_noise_model(backend, qubits=None):
+    #qubits: physical qubits used by the circuit, None for the noise model of the whole device
+    with _noise_models_lock:
+        if backend not in _noise_models:
+            from qiskit_aer.noise import NoiseModel  # type: ignore
+            from qiskit_ibm_runtime.fake_provider import FakeProviderForBackendV2  # type: ignore
+            _noise_models[backend] = NoiseModel.from_backend(FakeProviderForBackendV2().backend(backend[4:]))
+        if qubits is None:
+            return _noise_models[backend]
+        if not can_trim_noise_model(_noise_models[backend]):
+            if backend not in _untrimmed_backends:
+                logger.warning(f"The noise model of {backend} cannot be restricted to the qubits with this version of qiskit-aer, the full model is used")
+                _untrimmed_backends.add(backend)
+            return _noise_models[backend]
+        key = (backend, tuple(sorted(qubits)))
+        if key not in _noise_models:
+            _noise_models[key] = trim_noise_model(_noise_models[backend], key[1])
+        return _noise_models[key]
+
+#speculative execution: a job is a straggler when it runs longer than STRAGGLER_FACTOR times its estimate, the time predicted by the planner model of
+#its backend (see planner.predict_job_time, calibrated if a calibration is given) times the median ratio between the times and the predictions of
+#the jobs completed by the backend, once it completed STRAGGLER_MIN_JOBS jobs (of all the backends before, unless the backend is calibrated)
+STRAGGLER_FACTOR = 3.0
+STRAGGLER_MIN_JOBS = 3
+
 class Dispatcher:
+
+    def __init__(self, shot_chunk_size=None, auto_simulation_method=False, workers=None, aer_options=None, emulated_backends=None, speculative=False, straggler_factor=STRAGGLER_FACTOR, calibration=None):
+        #shot_chunk_size: maximum number of shots of a single execution on a backend, None for no limit
+        self.shot_chunk_size = check_shot_chunk_size(shot_chunk_size)
+        #auto_simulation_method: choose the Aer simulation method of each circuit from its stats, otherwise Aer chooses it
+        self.auto_simulation_method = auto_simulation_method
+        #workers: maximum number of backends executing at the same time, None for no limit (see governor.py)
+        self.workers = workers
+        #aer_options: options of the AerSimulator, e.g. its number of threads (see governor.py)
+        self.aer_options = aer_options if aer_options is not None else {}
+        #emulated_backends: profiles of the backends of the emulated provider, by name (see emulator.py)
+        self.emulated_backends = emulated_backends if emulated_backends is not None else {}
+        #speculative: idle backends duplicate the straggler jobs of the other backends, see _run_speculative
+        self.speculative = speculative
+        self.straggler_factor = straggler_factor
+        #calibration: time model of the jobs of each backend, as the calibration of planner.py
+        self.calibration = calibration
+
+    def _get_options_fun(self, provider, backend):
+        if provider == emulator.PROVIDER:
+            #the emulated backend executes on its simulator, with the options of the simulator
+            provider, backend = "ibm_aer", emulator.get_profile(self.emulated_backends, backend)["simulator"]
+        if provider == "ibm_aer" and backend.startswith("aer.fake"):
+            #the noise model is given to each execution, restricted to the qubits of the circuit
+            return aer_run_options(backend, self.auto_simulation_method)
+        if provider == "ibm_aer" and self.auto_simulation_method:
+            return aer_run_options()
+        return None
     
     def _get_backend(self, provider, backend):
         if provider == "ibm_aer":
+            from qiskit_aer import AerSimulator  # type: ignore
             if backend.startswith("aer.fake"):
-                return AerSimulator(noise_model=NoiseModel.from_backend(FakeProviderForBackendV2().backend(backend[4:])))
+                #builds the noise model of the device, the executions use it restricted to their qubits
+                get_noise_model(backend)
+                return AerSimulator(**self.aer_options)
             if backend == "aer.perfect":
-                return AerSimulator()
-            
+                return AerSimulator(**self.aer_options)
+        if provider == emulator.PROVIDER:
+            profile = emulator.get_profile(self.emulated_backends, backend)
+            return emulator.EmulatedBackend(backend, profile, self._get_backend("ibm_aer", profile["simulator"]))
+
         raise ValueError(f"Backend {backend} not supported for provider {provider}. Please send a message to Giuseppe to add it, but only if you think it is very, very important to have it. Capito Ale?!")
     
+    def _run_on_backend(self, semaphore, *args):
+        if semaphore is None:
+            return run_circuits_on_backend(*args)
+        with semaphore:
+            return run_circuits_on_backend(*args)
+
+    def _run_speculative(self, dispatch):
+        #each backend executes its jobs one at a time. A backend without jobs duplicates the job of another backend running longer than
+        #straggler_factor times its estimate, or takes the jobs queued behind it: the first result of a job is kept, under the backend that
+        #produced it (so that the merge weights it as that backend), the other copy is cancelled and run returns without waiting for it
+        semaphore = threading.BoundedSemaphore(self.workers) if self.workers else None
+        condition = threading.Condition()
+        jobs = []
+        queues = {}
+        backends = {}
+        options_funs = {}
+        for provider in dispatch:
+            for backend in dispatch[provider]:
+                backends[(provider, backend)] = self._get_backend(provider, backend)
+                options_funs[(provider, backend)] = self._get_options_fun(provider, backend)
+                queues[(provider, backend)] = collections.deque()
+                for circuit, shots in dispatch[provider][backend]:
+                    queues[(provider, backend)].append(len(jobs))
+                    jobs.append(((provider, backend), circuit, shots, circuit.describe()))
+        #imported here, planner imports the pipeline
+        import planner
+        models = {b: planner.backend_model(self.calibration, b[0], b[1]) for b in queues}
+        calibrated = {b for b in queues if self.calibration and (b[1] in self.calibration or f"{b[0]}/{b[1]}" in self.calibration)}
+        #running: backend -> (job, start, cancel token); copies: job -> backends running it; winners: job -> (backend, Job or None);
+        #ratios: backend -> times of its completed jobs over their predictions
+        state = {"running": {}, "copies": collections.defaultdict(set), "winners": {}, "ratios": collections.defaultdict(list), "error": None}
+
+        def finished():
+            return len(state["winners"]) == len(jobs) or state["error"] is not None
+
+        def limit(b, job_id):
+            ratios = state["ratios"][b]
+            if len(ratios) < STRAGGLER_MIN_JOBS:
+                if b in calibrated:
+                    #the calibrated model is trusted until the backend completes its first jobs
+                    ratios = [1.0]
+                else:
+                    ratios = [r for backend_ratios in state["ratios"].values() for r in backend_ratios]
+                    if len(ratios) < STRAGGLER_MIN_JOBS:
+                        return None
+            _, _, shots, stats = jobs[job_id]
+            return self.straggler_factor * statistics.median(ratios) * planner.predict_job_time(models[b], stats, shots)
+
+        def stragglers(now):
+            #jobs running past their limit, the slowest first
+            found = []
+            for other, (job_id, start, _) in state["running"].items():
+                job_limit = limit(other, job_id)
+                if job_limit is not None and now - start > job_limit:
+                    found.append(((now - start) / max(job_limit, 1e-9), other, job_id))
+            return [(other, job_id) for _, other, job_id in sorted(found, key=lambda x: x[0], reverse=True)]
+
+        def next_job(b):
+            #called holding the condition
+            if queues[b]:
+                return queues[b].popleft()
+            slow = stragglers(perf_counter())
+            for other, job_id in slow:
+                if len(state["copies"][job_id]) == 1 and job_id not in state["winners"]:
+                    logger.info(f"{b[1]}: duplicating the straggler job {job_id} of {other[1]}")
+                    return job_id
+            for other, _ in slow:
+                if queues[other]:
+                    logger.info(f"{b[1]}: taking a job queued on the straggler {other[1]}")
+                    return queues[other].pop()
+            return None
+
+        def next_check():
+            #time to wait before a running job becomes a straggler, None to wait for a job to complete
+            now = perf_counter()
+            deadlines = [start + limit(b, job_id) - now for b, (job_id, start, _) in state["running"].items() if limit(b, job_id) is not None]
+            deadlines = [deadline for deadline in deadlines if deadline > 0]
+            return max(min(deadlines), 0.01) if deadlines else None
+
+        def work(b):
+            while True:
+                with condition:
+                    job_id = None
+                    while not finished():
+                        job_id = next_job(b)
+                        if job_id is not None:
+                            break
+                        condition.wait(next_check())
+                    if job_id is None:
+                        return
+                    cancel_token = CancelToken()
+                    state["running"][b] = (job_id, perf_counter(), cancel_token)
+                    state["copies"][job_id].add(b)
+                origin, circuit, shots, _ = jobs[job_id]
+                try:
+                    job = self._run_on_backend(semaphore, backends[b], [(circuit, shots)], self.shot_chunk_size, options_funs[b], MAX_JOB_ATTEMPTS, cancel_token)[0]
+                except Exception as e:  # pylint: disable=broad-except
+                    with condition:
+                        state["error"] = e
+                        condition.notify_all()
+                    return
+                with condition:
+                    del state["running"][b]
+                    state["copies"][job_id].discard(b)
+                    if job_id not in state["winners"]:
+                        if job is not None:
+                            if b != origin:
+                                job.results[0].info["speculated_from"] = f"{origin[0]}/{origin[1]}"
+                            state["winners"][job_id] = (b, job)
+                            info = job.results[0].info
+                            state["ratios"][b].append(info["time"] / planner.predict_job_time(models[b], info, info["shots"]))
+                            #the other copies of the job are cancelled, freeing their backends
+                            for other in state["copies"][job_id]:
+                                logger.info(f"{other[1]}: cancelling the copy of job {job_id} won by {b[1]}")
+                                state["running"][other][2].cancel()
+                        elif not state["copies"][job_id]:
+                            #no copy left, the failed job makes the execution restart
+                            state["winners"][job_id] = (origin, None)
+                    condition.notify_all()
+
+        for b in queues:
+            threading.Thread(target=work, args=(b,), daemon=True).start()
+        with condition:
+            while not finished():
+                condition.wait()
+        if state["error"] is not None:
+            raise state["error"]
+
+        results = {provider: {backend: [] for backend in dispatch[provider]} for provider in dispatch}
+        for job_id in range(len(jobs)):
+            (provider, backend), job = state["winners"][job_id]
+            results[provider][backend].append(job)
+        return results
+
     def run(self, dispatch):
+        if self.speculative:
+            return self._run_speculative(dispatch)
+        #the threads of the backends share the workers
+        semaphore = threading.BoundedSemaphore(self.workers) if self.workers else None
         threads = {}
         for provider in dispatch:
             if provider not in threads:
@@ -241,7 +751,7 @@ class Dispatcher:
                 if _backend is None:
                     raise ValueError(f"Backend {backend} not supported for provider {provider}")
                 
-                threads[provider][backend] = ThreadWithReturnValue(target=run_circuits_on_backend, args=(_backend, dispatch[provider][backend]))
+                threads[provider][backend] = ThreadWithReturnValue(target=self._run_on_backend, args=(semaphore, _backend, dispatch[provider][backend], self.shot_chunk_size, self._get_options_fun(provider, backend)))
                 threads[provider][backend].start()
                 
         results = {}
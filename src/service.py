@@ -0,0 +1,376 @@
+'''
+This file implements the service mode of Cut&Shoot: a long-running process that exposes cutnshot.cutnshot over a
+local HTTP API. Between requests the service keeps warm the imported policy and cutting modules, the cut results
+(keyed by circuit, observable and cutting module) and the backends' noise models (cached by qukit).
+Jobs are queued per client and served round-robin across clients, so that a client submitting many runs does not
+starve the others.
+
+API:
+    - POST /jobs -> {"job_id": job_id}
+        body: JSON object with the fields
+            circuit: QASM circuit
+            observables: observable to measure, as in the configuration file
+            shots: number of total shots of the run
+            backends: list of [provider, backend]
+            cut_strategy_module, shots_allocation_module, sw_policy_module: names of the python modules to use
+            client: (optional) name of the client submitting the job, used for fair queueing
+            parallel_execution, times, params, stats: (optional) booleans, as the flags of main.py
+            shot_chunk_size: (optional) maximum number of shots of a single execution, as in the configuration file
+            resources: (optional) object with the cores, processes, dispatcher_workers and aer_threads of the run, as in the configuration file;
+                by default each run gets an equal share of the cores among the workers of the service
+            governor: (optional) boolean, false to disable the resource governor
+            preprocessing_processes: (optional) number of processes preprocessing the fragments, as in the configuration file
+            deferred_qasm_export: (optional) boolean, as in the configuration file
+            sampled_sewing, sampling_seed: (optional) boolean and seed of the sampled sewing, as in the configuration file
+            emulated_backends: (optional) profiles of the emulated backends, as in the configuration file
+            speculative_execution, straggler_factor: (optional) boolean and factor of the speculative execution, as in the configuration file
+            auto_simulation_method: (optional) boolean, whether the Aer simulation method is chosen per fragment (default false)
+            agents: (optional) list of [host, port] of the worker agents executing the jobs, as in the configuration file
+            agent_timeout, agent_job_timeout: (optional) timeouts of the agents in seconds, as in the configuration file
+            metadata: (optional) data that will be copied in the output
+    - GET /jobs -> list of the status of every job
+    - GET /jobs/<job_id> -> status of the job: queued, running, done or failed
+    - GET /jobs/<job_id>/result -> output of cutnshot.cutnshot for the job (409 if the job is not done yet)
+Finished jobs are kept for FINISHED_JOB_TTL seconds, at most MAX_FINISHED_JOBS of them, then they are unknown (404).
+Only the cutting tools (*_tool) and the policies shipped with Cut&Shoot can be used as modules.
+
+Each job runs in a worker process of the service, one job per process at a time: the cutting tools (e.g. PennyLane) are not thread-safe, so the
+pipelines of concurrent jobs must not share a process. The worker processes live as long as the service, each one keeps warm its own modules, cut
+cache and noise models. Only cut is cached: the variations of cut_deferred are consumed by the run and cut_sampled draws new samples at every run.
+'''
+import threading, json, importlib, logging, datetime, uuid, collections, os, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from time import monotonic
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cutnshot, governor
+from utils import hash_circuit, stats_to_json
+from qukit import check_shot_chunk_size
+
+logger = logging.getLogger("cutnshot")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+REQUIRED_FIELDS = ["circuit", "observables", "shots", "backends", "cut_strategy_module", "shots_allocation_module", "sw_policy_module"]
+CUT_CACHE_SIZE = 128
+FINISHED_JOB_TTL = 3600
+MAX_FINISHED_JOBS = 1000
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+#modules a client can ask for: the cutting tools and the policies shipped in the repository
+CUT_MODULES = {name[:-3] for name in os.listdir(SRC_DIR) if name.endswith("_tool.py")}
+POLICY_MODULES = {"policies."+name[:-3] for name in os.listdir(os.path.join(SRC_DIR, "policies")) if name.endswith(".py") and name != "__init__.py"}
+
+
+class CachedCutStrategy:
+    '''Wraps a cutting module, memoizing its cut function. Every other attribute is the one of the module, e.g. cut_deferred and
+    cut_sampled are not cached.'''
+
+    def __init__(self, module, max_size=CUT_CACHE_SIZE):
+        self.module = module
+        self.__name__ = module.__name__
+        self.max_size = max_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def cut(self, circuit, observable_string):
+        key = (hash_circuit(circuit), json.dumps(observable_string))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                cut_res = self._cache[key]
+            else:
+                cut_res = None
+        if cut_res is None:
+            cut_res = self.module.cut(circuit, observable_string)
+            with self._lock:
+                self._cache[key] = cut_res
+                if len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+        #the pipeline adds the fragments stats to the cut output, it must not change the cached one
+        return (list(cut_res[0]),) + tuple(cut_res[1:])
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+
+class FairQueue:
+    '''Queue with one FIFO per client, served round-robin across the clients.'''
+
+    def __init__(self):
+        self._queues = collections.OrderedDict()
+        self._condition = threading.Condition()
+
+    def put(self, client, item):
+        with self._condition:
+            if client not in self._queues:
+                self._queues[client] = collections.deque()
+            self._queues[client].append(item)
+            self._condition.notify()
+
+    def get(self):
+        with self._condition:
+            while not self._queues:
+                self._condition.wait()
+            client, queue = self._queues.popitem(last=False)
+            item = queue.popleft()
+            if queue:
+                #the client goes back at the end of the round
+                self._queues[client] = queue
+            return item
+
+
+#modules imported by a worker process, the cutting modules with their cut cache
+_modules = {}
+
+def get_module(name, cut=False):
+    if name not in (CUT_MODULES if cut else POLICY_MODULES):
+        raise ValueError(f"Module {name} is not shipped with Cut&Shoot")
+    if name not in _modules:
+        module = importlib.import_module(name)
+        _modules[name] = CachedCutStrategy(module) if cut else module
+    return _modules[name]
+
+def init_worker(level):
+    #the worker processes are spawned, they log as the service
+    logging.basicConfig(level=logging.ERROR)
+    logger.setLevel(level)
+
+
+class JobManager:
+
+    def __init__(self, workers=2, finished_job_ttl=FINISHED_JOB_TTL, max_finished_jobs=MAX_FINISHED_JOBS):
+        self.jobs = {}
+        self.finished_job_ttl = finished_job_ttl
+        self.max_finished_jobs = max_finished_jobs
+        #(finish time, job_id) of the finished jobs, oldest first
+        self._finished = collections.deque()
+        self.queue = FairQueue()
+        self._lock = threading.Lock()
+        #the threads of the workers take the jobs from the queue, each job runs in a process of the pool
+        self._pool_lock = threading.Lock()
+        self._pool_size = workers
+        self._pool = self._new_pool()
+        self.workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _new_pool(self):
+        #spawned, a fork would copy the locks held by the threads of the service
+        return ProcessPoolExecutor(max_workers=self._pool_size, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(logger.level,))
+
+    def submit(self, request):
+        missing = [field for field in REQUIRED_FIELDS if field not in request]
+        if missing:
+            raise ValueError(f"Missing fields {missing}")
+        if request["cut_strategy_module"] not in CUT_MODULES:
+            raise ValueError(f"Unknown cutting module {request['cut_strategy_module']}, available: {sorted(CUT_MODULES)}")
+        for field in ["shots_allocation_module", "sw_policy_module"]:
+            if request[field] not in POLICY_MODULES:
+                raise ValueError(f"Unknown policy module {request[field]}, available: {sorted(POLICY_MODULES)}")
+        if "shot_chunk_size" in request:
+            check_shot_chunk_size(int(request["shot_chunk_size"]))
+        if request.get("agents") and request.get("speculative_execution"):
+            raise ValueError("speculative_execution is not supported with agents")
+        job_id = str(uuid.uuid4())
+        client = str(request.get("client", "default"))
+        job = {
+            "job_id": job_id,
+            "client": client,
+            "status": QUEUED,
+            "submitted": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "started": None,
+            "finished": None,
+            "error": None,
+        }
+        with self._lock:
+            self._evict()
+            self.jobs[job_id] = {"info": job, "request": request, "result": None}
+        self.queue.put(client, job_id)
+        return job_id
+
+    def status(self, job_id):
+        with self._lock:
+            if job_id not in self.jobs:
+                return None
+            return self.jobs[job_id]["info"].copy()
+
+    def statuses(self):
+        with self._lock:
+            self._evict()
+            return [job["info"].copy() for job in self.jobs.values()]
+
+    def result(self, job_id):
+        with self._lock:
+            if job_id not in self.jobs:
+                return None, None
+            return self.jobs[job_id]["info"]["status"], self.jobs[job_id]["result"]
+
+    def _set(self, job_id, **fields):
+        with self._lock:
+            self.jobs[job_id]["info"].update(fields)
+
+    def _evict(self):
+        #called holding the lock: forgets the finished jobs past their TTL and the oldest ones beyond the maximum
+        now = monotonic()
+        while self._finished and (len(self._finished) > self.max_finished_jobs or now - self._finished[0][0] > self.finished_job_ttl):
+            _, job_id = self._finished.popleft()
+            del self.jobs[job_id]
+
+    def _finish(self, job_id, result=None, **fields):
+        with self._lock:
+            self.jobs[job_id]["info"].update(fields, finished=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            self.jobs[job_id]["result"] = result
+            #the request is not needed anymore, the circuit can be released
+            self.jobs[job_id]["request"] = None
+            self._finished.append((monotonic(), job_id))
+            self._evict()
+
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            with self._lock:
+                request = self.jobs[job_id]["request"]
+            self._set(job_id, status=RUNNING, started=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            logger.info(f"Running job {job_id} "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            try:
+                with self._pool_lock:
+                    pool = self._pool
+                try:
+                    result = pool.submit(run, request, len(self.workers)).result()
+                except BrokenProcessPool:
+                    #a worker process died (e.g. out of memory): the pool is replaced for the next jobs
+                    with self._pool_lock:
+                        if self._pool is pool:
+                            self._pool = self._new_pool()
+                    raise
+                self._finish(job_id, result, status=DONE)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception(f"Job {job_id} failed")
+                self._finish(job_id, status=FAILED, error=repr(e))
+
+
+def run(request, workers):
+    #runs the job in a worker process, workers is the number of jobs of the service running at the same time
+    times_flag = bool(request.get("times", False))
+    params_flag = bool(request.get("params", False))
+    stats_flag = bool(request.get("stats", False))
+    input_flags = {
+        "times_flag": times_flag or params_flag or stats_flag,
+        "params_flag": params_flag,
+        "stats_flag": stats_flag,
+        "parallel_execution_flag": bool(request.get("parallel_execution", False)),
+    }
+    if "agents" in request:
+        input_flags["agents"] = request["agents"]
+    for field in ["agent_timeout", "agent_job_timeout"]:
+        if field in request:
+            input_flags[field] = float(request[field])
+    if "shot_chunk_size" in request:
+        input_flags["shot_chunk_size"] = check_shot_chunk_size(int(request["shot_chunk_size"]))
+    if "resources" in request:
+        input_flags["resources"] = {key: int(value) for key, value in request["resources"].items() if key in ["cores", "processes", "dispatcher_workers", "aer_threads"]}
+    #the runs of the workers share the cores of the machine
+    input_flags.setdefault("resources", {}).setdefault("cores", governor.share_cores(workers))
+    input_flags["governor"] = bool(request.get("governor", True))
+    if "preprocessing_processes" in request:
+        input_flags["preprocessing_processes"] = int(request["preprocessing_processes"])
+    if "deferred_qasm_export" in request:
+        input_flags["deferred_qasm_flag"] = bool(request["deferred_qasm_export"])
+    if "sampled_sewing" in request:
+        input_flags["sampling_flag"] = bool(request["sampled_sewing"])
+    if "sampling_seed" in request:
+        input_flags["sampling_seed"] = int(request["sampling_seed"])
+    if "emulated_backends" in request:
+        input_flags["emulated_backends"] = request["emulated_backends"]
+    if "speculative_execution" in request:
+        input_flags["speculative_flag"] = bool(request["speculative_execution"])
+    if "straggler_factor" in request:
+        input_flags["straggler_factor"] = float(request["straggler_factor"])
+    if "auto_simulation_method" in request:
+        input_flags["auto_simulation_method"] = bool(request["auto_simulation_method"])
+    cut_strategy_module = get_module(request["cut_strategy_module"], cut=True)
+    if hasattr(cut_strategy_module.module, "processes"):
+        #the search of the cut runs on the share of the cores of the worker
+        cut_strategy_module.module.processes = cutnshot.get_pool_processes(input_flags)
+    result = cutnshot.cutnshot(
+        request["circuit"],
+        request["observables"],
+        int(request["shots"]),
+        request["backends"],
+        cut_strategy_module,
+        get_module(request["shots_allocation_module"]),
+        get_module(request["sw_policy_module"]),
+        input_flags,
+        request.get("metadata", None)
+    )
+    if stats_flag:
+        result["stats"] = stats_to_json(result["stats"])
+    #checks that the result can be sent back to the client
+    return json.loads(json.dumps(result))
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            job_id = self.server.manager.submit(request)
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send(400, {"error": str(e)})
+            return
+        self._send(202, {"job_id": job_id})
+
+    def do_GET(self):
+        parts = [p for p in self.path.split("/") if p]
+        manager = self.server.manager
+        if parts == ["jobs"]:
+            self._send(200, manager.statuses())
+        elif len(parts) == 2 and parts[0] == "jobs":
+            status = manager.status(parts[1])
+            if status is None:
+                self._send(404, {"error": f"Unknown job {parts[1]}"})
+            else:
+                self._send(200, status)
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "result":
+            status, result = manager.result(parts[1])
+            if status is None:
+                self._send(404, {"error": f"Unknown job {parts[1]}"})
+            elif status != DONE:
+                self._send(409, manager.status(parts[1]))
+            else:
+                self._send(200, result)
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(host="127.0.0.1", port=8080, workers=2):
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.manager = JobManager(workers)
+    logger.info(f"Cut&Shoot service listening on {host}:{port} with {workers} workers "+datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
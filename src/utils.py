@@ -1,13 +1,54 @@
-import hashlib
+import hashlib, json
 from qukit import VirtualCircuit
-from pennylane import qml
 from time import process_time
 
+# pennylane is imported lazily by the functions below: it is only needed once fragments are
+# available, and loading it at import time slows down the start-up of every run.
+
 
 def hash_circuit(qasm):
     return str(hashlib.md5(qasm.encode()).hexdigest())
 
+def observable_terms(observable):
+    #observable can be a Pauli string ("XZY"), a dict {pauli_string: coefficient} or a list of [coefficient, pauli_string]
+    if isinstance(observable, str):
+        terms = [(1.0, observable)]
+    elif isinstance(observable, dict):
+        terms = [(float(coeff), pauli) for pauli, coeff in observable.items()]
+    else:
+        terms = []
+        for term in observable:
+            if isinstance(term, str):
+                terms.append((1.0, term))
+            elif isinstance(term[0], str):
+                terms.append((float(term[1]), term[0]))
+            else:
+                terms.append((float(term[0]), term[1]))
+    if not terms:
+        raise ValueError("Empty observable")
+    for _, pauli in terms:
+        if len(pauli) != len(terms[0][1]):
+            raise ValueError(f"Pauli strings of different lengths in the observable {observable}")
+        for p in pauli:
+            if p not in "IXYZ":
+                raise ValueError(f"Invalid observable {pauli}")
+    return terms
+
+def is_observable_term(term):
+    #a term of a Pauli sum in list form: [coefficient, pauli_string] or [pauli_string, coefficient]
+    if not isinstance(term, (list, tuple)) or len(term) != 2:
+        return False
+    number = lambda x: isinstance(x, (int, float)) and not isinstance(x, bool)
+    return (number(term[0]) and isinstance(term[1], str)) or (isinstance(term[0], str) and number(term[1]))
+
+def is_single_observable(observables):
+    #a Pauli string, a dict or a list of terms is one observable, any other list has an observable per circuit
+    if isinstance(observables, (str, dict)):
+        return True
+    return len(observables) > 0 and all(is_observable_term(term) for term in observables)
+
 def string_to_qml_pauli_word(observable):
+    from pennylane import qml
     qubits = list(range(len(observable)))
     obs = qml.pauli.string_to_pauli_word(observable[0])
     for q in qubits[1:]:
@@ -34,6 +75,7 @@ def expected_values(probs, vcs, old_vcs):
     return results
 
 def compute_expected_value(probabilities, observable):
+    from pennylane import qml
     expected_value = 0
     eigvals = qml.eigvals(string_to_qml_pauli_word(observable))
     for state, probability in probabilities.items():
@@ -42,11 +84,12 @@ def compute_expected_value(probabilities, observable):
     return expected_value.real
 
 def qasm_to_pennylane(qasm: str):
+    from pennylane import qml
     qasm_circuit = qml.from_qasm(qasm)
     def fun():
         qasm_circuit()
     return fun
-def pennylane_to_qasm(circuit: qml.QNode) -> str:
+def pennylane_to_qasm(circuit) -> str:
     if hasattr(circuit, "tape"):
         c = circuit.tape.to_openqasm()
         
@@ -55,6 +98,7 @@ def pennylane_to_qasm(circuit: qml.QNode) -> str:
     return c
 
 def push_obs(virtual_circuit):
+    from pennylane import qml
     qasm_circuit = virtual_circuit.circuit
     observable_string = virtual_circuit.metadata["observable"]
     num_qubits = virtual_circuit.metadata["qubits"]
@@ -100,6 +144,16 @@ def create_dispatch(vcs_shots, provider_backend_couples, split_fun):
             dispatch = create_single_dispatch(dispatch, fragment, provider, backend, split_shots)
     return dispatch, splitted_coefficients
 
+def create_policy_dispatch(vcs_shots, provider_backend_couples, sw_policy_module):
+    #policies implementing split_fragments assign the fragments to the backends all together, the others split each fragment on its own
+    if hasattr(sw_policy_module, "split_fragments"):
+        dispatch = {}
+        assignments, coefficients = sw_policy_module.split_fragments(provider_backend_couples, vcs_shots)
+        for fragment, provider, backend, shots in assignments:
+            dispatch = create_single_dispatch(dispatch, fragment, provider, backend, shots)
+        return dispatch, coefficients
+    return create_dispatch(vcs_shots, provider_backend_couples, sw_policy_module.split)
+
 def results_to_counts(results_dispatcher):
     try:
         counts_dispatcher = {}
@@ -120,6 +174,133 @@ def results_to_counts(results_dispatcher):
             print("IBM ha fallito, rilancio l'esecuzione.")
             return None
         raise e
+
+def results_to_info(results_dispatcher):
+    #information recorded by the backends about each execution, e.g. the simulation method
+    info_dispatcher = {}
+    for provider in results_dispatcher:
+        info_dispatcher[provider] = {}
+        for backend in results_dispatcher[provider]:
+            info_dispatcher[provider][backend] = []
+            for job in results_dispatcher[provider][backend]:
+                if job is None:
+                    continue
+                result = job.results[0]
+                info_dispatcher[provider][backend].append((result.circuit.metadata["circuit_name"], result.circuit.metadata["observable"], getattr(result, "info", {})))
+    return info_dispatcher
+
+def expected_values_by_hash(probs):
+    #expected values keyed by (hash of the fragment, observable), without the QASM of the fragments (see HashKeyedValues)
+    return {(circuit_id, observable): compute_expected_value(probabilities, observable) for (circuit_id, observable), probabilities in probs.items()}
+
+def hash_fragments(data):
+    #copy of the sew data of a cutting tool with the QASM of the fragments replaced by their hash, the lists shared by its parts stay shared
+    copies = {}
+    def copy(value):
+        if isinstance(value, str):
+            return hash_circuit(value) if value.lstrip().startswith("OPENQASM") else value
+        if not isinstance(value, (dict, list, tuple)):
+            return value
+        if id(value) not in copies:
+            if isinstance(value, dict):
+                copies[id(value)] = {k: copy(v) for k, v in value.items()}
+            else:
+                copies[id(value)] = type(value)(copy(v) for v in value)
+        return copies[id(value)]
+    return copy(data)
+
+class HashKeyedValues:
+    """Expected values keyed by the hash of the fragments, looked up by the sew with the hash of the fragments (see hash_fragments)
+    or with their QASM.
+
+    Parameters
+    ----------
+    values : dict
+        The expected values, {(fragment hash, observable): expected value}.
+    """
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        qasm, observable = key
+        return self.values[(hash_circuit(qasm), observable)]
+
+    def __contains__(self, key):
+        return key in self.values or (hash_circuit(key[0]), key[1]) in self.values
+
+class StatsSpill:
+    """Writes the stats of a run to a JSON-lines file as they are produced, instead of keeping them in memory.
+
+    Each line is {"stat": name, "value": value}, or {"stat": name, "key": key, "value": value} for the stats written
+    one entry at a time (e.g. one per backend), see load_stats.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "w")
+
+    def write(self, stat, value, key=None):
+        entry = {"stat": stat, "value": value} if key is None else {"stat": stat, "key": key, "value": value}
+        self._file.write(json.dumps(entry, default=float)+"\n")
+
+    def close(self):
+        #closing twice is allowed, the run closes the file also when it fails
+        self._file.close()
+        return {"stats_file": self.path}
+
+def load_stats(path):
+    #stats spilled by StatsSpill, the ones written one entry at a time are loaded as dictionaries
+    stats = {}
+    with open(path, "r") as f:
+        for line in f:
+            entry = json.loads(line)
+            if "key" in entry:
+                stats.setdefault(entry["stat"], {})[entry["key"]] = entry["value"]
+            else:
+                stats[entry["stat"]] = entry["value"]
+    return stats
+
+def stats_to_json(stats):
+    #make the stats of a run JSON serializable
+    if "stats_file" in stats:
+        #spilled to disk in low-memory mode, they are already JSON
+        return stats.copy()
+    stats = stats.copy()
+    if "dispatch" in stats:
+        dispatch = stats["dispatch"]
+        new_dispatch = {}
+        for provider in dispatch:
+            for backend in dispatch[provider]:
+                if provider not in new_dispatch:
+                    new_dispatch[provider] = {}
+                if backend not in new_dispatch[provider]:
+                    new_dispatch[provider][backend] = []
+                for frag, shots in dispatch[provider][backend]:
+                    new_dispatch[provider][backend].append((frag.circuit, shots))
+        stats["dispatch"] = new_dispatch
+
+    if "probs" in stats:
+        probs = stats["probs"]
+        new_probs = {}
+        for k in probs:
+            new_probs[str(k)] = probs[k]
+        stats["probs"] = new_probs
+
+    if "exp_values" in stats:
+        qasm_obs_exp_values = stats["exp_values"]
+        exp_vals = {}
+        for qasm, obs in qasm_obs_exp_values:
+            hash = hash_circuit(qasm)
+            exp_vals[str((hash,obs))] = qasm_obs_exp_values[(qasm, obs)]
+        stats["exp_values"] = exp_vals
+    return stats
+
 def record_time(times, name, start):
     end = process_time()
     times[name] = (end - start) #in seconds